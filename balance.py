@@ -3,7 +3,7 @@
 # Fetches balance for a single address or entire wallet
 
 import sys, argparse, logging
-from btclib import config, logger, get_balance, get_bitcoin_price, get_wallet, lookup
+from btclib import config, logger, get_balances, get_bitcoin_price, get_wallet, lookup
 
 
 def main():
@@ -14,6 +14,7 @@ def main():
     parser.add_argument('-f', '--from', help='get balances from just these addresses', nargs='+', required=False)
     parser.add_argument('-v', '--verbose', help='show verbose output', action='store_true', required=False)
     parser.add_argument('-c', '--cache', help='use cached data only', action='store_true', required=False)
+    parser.add_argument('-j', '--jobs', help='number of balances to fetch concurrently', type=int, required=False)
     args = vars(parser.parse_args())
 
     if (args['verbose']):
@@ -22,7 +23,7 @@ def main():
         logger.setLevel(logging.WARNING)
 
     # report column format
-    fmt = '%-40s %-40s %12s %12s'
+    fmt = '%-40s %-42s %12s %12s'
     rpt = '\n' + fmt % ('Name', 'Address', 'BTC','USD') + '\n\n'
 
     # fetch balances
@@ -49,26 +50,30 @@ def main():
             found['address'] = args['from'][0]
         entries = [ found ]
 
-    # create report
+    # only get balances for active addresses you own
+    shown = []
     for item in entries:
+        if (item['privkey'] is not None and item['active']) or args['showall'] or single_address:
+            shown.append(item)
+
+    balances = get_balances([item['address'] for item in shown], args['cache'], args['jobs'])
+
+    # create report
+    for item, satoshi in zip(shown, balances):
 
         name = item['name']
         addr = item['address']
-        active = item['active']
-
-        # only get balances for active addresses you own
-        if (item['privkey'] is not None and active) or args['showall'] or single_address:
-            satoshi = get_balance(addr, args['cache'])
-            if satoshi is None:
-                logger.critical('unable to fetch balances')
-                exit(1)
-            bal = float(satoshi) / 1e8
-            total += bal
-            bal_disp = '{:,.8f}'.format(bal)
-            usd_disp = '{:,.2f}'.format(bal*btc)
-
-            if (bal > 0) or args['showall'] or single_address:
-                rpt += fmt % (name, addr, bal_disp, usd_disp) + '\n'
+
+        if satoshi is None:
+            logger.critical('unable to fetch balances')
+            exit(1)
+        bal = float(satoshi) / 1e8
+        total += bal
+        bal_disp = '{:,.8f}'.format(bal)
+        usd_disp = '{:,.2f}'.format(bal*btc)
+
+        if (bal > 0) or args['showall'] or single_address:
+            rpt += fmt % (name, addr, bal_disp, usd_disp) + '\n'
 
     # totals
     if not single_address:
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+# Compare coin selection algorithms on large random UTXO sets: time to
+# select, inputs used, whether change was created and the fee paid.
+
+import sys, argparse, random, time
+from coinselect import select_coins, algorithms
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark coin selection on large UTXO sets')
+    parser.add_argument('-n', '--utxos', help='number of UTXOs', type=int, required=False, default=10000)
+    parser.add_argument('-p', '--payments', help='number of payments per algorithm', type=int, required=False, default=20)
+    parser.add_argument('-m', '--fee', help='fee in Satoshis per byte', type=int, required=False, default=20)
+    parser.add_argument('-l', '--longterm', help='long term fee in Satoshis per byte', type=int, required=False, default=10)
+    parser.add_argument('-s', '--seed', help='random seed', type=int, required=False, default=1)
+    args = vars(parser.parse_args())
+
+    rng = random.Random(args['seed'])
+    sizes = { 'base' : 10, 'input' : 180, 'output' : 34 }
+
+    # log-normal values from dust to a few BTC, like a busy wallet
+    utxos = [ { 'value' : int(rng.lognormvariate(13, 2)) + 546 } for i in range(args['utxos']) ]
+    total = sum([u['value'] for u in utxos])
+    payments = [ int(rng.lognormvariate(15, 1.5)) for i in range(args['payments']) ]
+    payments = [ p for p in payments if p < total / 2 ]
+
+    sys.stdout.write('{:,} UTXOs holding {:,.8f} BTC, {} payments at {} sat/byte\n\n'.format(len(utxos), total / 1e8, len(payments), args['fee']))
+    # spending change later costs another input
+    fmt = '{:16s} {:>12s} {:>10s} {:>10s} {:>14s} {:>14s} {:>14s}\n'
+    sys.stdout.write(fmt.format('Algorithm', 'ms/payment', 'inputs', 'changeless', 'fee sat', 'to miner sat', 'w/ change sat'))
+
+    for algorithm in algorithms:
+        elapsed = 0.0
+        inputs = 0
+        changeless = 0
+        fees = 0
+        excess = 0
+        lifetime = 0
+        for amount in payments:
+            start = time.time()
+            selection = select_coins(utxos, amount, args['fee'], sizes, algorithm, rng=random.Random(amount), long_term_fee=args['longterm'])
+            elapsed += time.time() - start
+            inputs += len(selection['inputs'])
+            changeless += 1 if selection['change'] == 0 else 0
+            fees += selection['fee']
+            excess += selection['excess']
+            lifetime += selection['fee'] + (sizes['input'] * args['longterm'] if selection['change'] else 0)
+
+        n = float(len(payments))
+        sys.stdout.write(fmt.format(algorithm, '{:.1f}'.format(elapsed * 1000 / n), '{:.1f}'.format(inputs / n),
+                                    '{}/{}'.format(changeless, len(payments)), '{:,.0f}'.format(fees / n), '{:,.0f}'.format(excess / n),
+                                    '{:,.0f}'.format(lifetime / n)))
+
+    sys.stdout.write('\n')
+
+
+if __name__ == "__main__":
+    main()
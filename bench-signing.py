@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+# Time signing sweeps of 10, 100 and 1,000 inputs one input at a time
+# with bitcoin.sign() and all at once with txsign.sign_inputs(), and
+# check both produce the same transaction.
+
+import sys, argparse, random, time, multiprocessing
+from bitcoin import mktx, sign, sha256, privtopub, pubtoaddr, encode_privkey
+from txsign import sign_inputs
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark signing transactions with many inputs')
+    parser.add_argument('-i', '--inputs', help='input counts to try', nargs='+', type=int, required=False, default=[10, 100, 1000])
+    parser.add_argument('-k', '--keys', help='number of distinct private keys', type=int, required=False, default=5)
+    parser.add_argument('-p', '--processes', help='signing processes', type=int, required=False, default=multiprocessing.cpu_count())
+    parser.add_argument('-s', '--serial-max', help='largest sweep to also sign serially, it is quadratic', type=int, required=False, default=100)
+    args = vars(parser.parse_args())
+
+    rng = random.Random(1)
+    privkeys = [ encode_privkey(sha256('bench {}'.format(k)), 'wif_compressed') for k in range(args['keys']) ]
+    dest = pubtoaddr(privtopub(privkeys[0]))
+
+    sys.stdout.write('Signing with {} process{}\n\n'.format(args['processes'], '' if args['processes'] == 1 else 'es'))
+    fmt = '{:>8s} {:>12s} {:>12s} {:>10s} {:>10s}\n'
+    sys.stdout.write(fmt.format('Inputs', 'serial s', 'parallel s', 'speedup', 'identical'))
+
+    for n in args['inputs']:
+        txins = [ { 'output' : '{:064x}:{}'.format(rng.getrandbits(256), rng.randint(0, 3)), 'value' : 100000 } for i in range(n) ]
+        tx = mktx(txins, [ { 'address' : dest, 'value' : 50000 * n } ])
+        keys = [ privkeys[rng.randrange(len(privkeys))] for i in range(n) ]
+
+        start = time.time()
+        signed, failed = sign_inputs(tx, keys, args['processes'])
+        parallel = time.time() - start
+        if failed:
+            sys.stdout.write('Failed to sign inputs {}\n'.format(failed))
+            exit(1)
+
+        if n > args['serial_max']:
+            sys.stdout.write(fmt.format('{:,}'.format(n), '-', '{:.2f}'.format(parallel), '-', '-'))
+            continue
+
+        start = time.time()
+        serial = tx
+        for i in range(n):
+            serial = sign(serial, i, keys[i])
+        elapsed = time.time() - start
+
+        sys.stdout.write(fmt.format('{:,}'.format(n), '{:.2f}'.format(elapsed), '{:.2f}'.format(parallel),
+                                    '{:.1f}x'.format(elapsed / parallel), 'yes' if serial == signed else 'NO'))
+
+    sys.stdout.write('\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+# Measure startup time of each command and the import cost of the
+# libraries btclib depends on. Every sample runs in a fresh
+# interpreter, the way cron and monitoring invoke the scripts.
+
+import sys, os, argparse, subprocess, time
+
+
+entry_points = [ 'balance.py', 'consolidate.py', 'fee.py', 'list.py', 'memo.py', 'payouts.py', 'price.py', 'sendbtc.py',
+                'verify-keys.py', 'walletd.py' ]
+modules = [ 'btclib', 'validate', 'requests', 'yaml', 'bsddb', 'json', 'datetime', 'bitcoin' ]
+
+
+# return the median wall clock time of running a command in seconds
+def median_time(command, runs):
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            start = time.time()
+            subprocess.call(command, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark command startup and import times')
+    parser.add_argument('-n', '--runs', help='samples per measurement', type=int, required=False, default=10)
+    args = vars(parser.parse_args())
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(here)
+    python = sys.executable
+    runs = args['runs']
+
+    baseline = median_time([python, '-c', 'pass'], runs)
+    sys.stdout.write('{:20s} {:>10s}\n\n'.format('Interpreter', 'ms'))
+    sys.stdout.write('{:20s} {:10.1f}\n\n'.format('python', baseline * 1000))
+
+    # commands only parse their arguments with -h and exit
+    sys.stdout.write('{:20s} {:>10s}\n\n'.format('Command -h', 'ms'))
+    for script in entry_points:
+        elapsed = median_time([python, script, '-h'], runs) - baseline
+        sys.stdout.write('{:20s} {:10.1f}\n'.format(script, elapsed * 1000))
+
+    # first import of each module on its own
+    sys.stdout.write('\n{:20s} {:>10s}\n\n'.format('Import', 'ms'))
+    for module in modules:
+        elapsed = median_time([python, '-c', 'import {}'.format(module)], runs) - baseline
+        sys.stdout.write('{:20s} {:10.1f}\n'.format(module, elapsed * 1000))
+
+    sys.stdout.write('\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,244 @@
 
-import datetime, bsddb, os, yaml, logging, requests, string, json, re, sys
-from validate import validate_address
+import os, logging, string, re, sys, threading, time, atexit, random, hashlib, marshal, importlib, functools, shutil
+import array, bisect, binascii, fcntl, contextlib
+from validate import validate_address, validate_addresses
 
 # logger
 logging.basicConfig(format='%(asctime)-15s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
 
 
+# module proxy that imports the real module on first attribute access,
+# so scripts only pay for the dependencies they actually use
+class LazyModule(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+bsddb = LazyModule('bsddb')
+datetime = LazyModule('datetime')
+json = LazyModule('json')
+requests = LazyModule('requests')
+yaml = LazyModule('yaml')
+
+
+# use the C YAML parser when libyaml is available
+def yaml_loader():
+    return getattr(yaml, 'CLoader', yaml.Loader)
+
+
+# config dictionary whose wallet section is loaded on first access
+class Config(dict):
+
+    def __init__(self, values, wallet_loader=None):
+        dict.__init__(self, values)
+        self.wallet_loader = wallet_loader
+
+    def __missing__(self, key):
+        if key != 'wallet' or self.wallet_loader is None:
+            raise KeyError(key)
+        self['wallet'] = self.wallet_loader()
+        self.wallet_loader = None
+        return self['wallet']
+
+
+# split config text into the top-level wallet block and everything else
+def split_wallet_section(text):
+
+    rest = []
+    wallet = []
+    in_wallet = False
+
+    for line in text.splitlines(True):
+        if re.match('^wallet\s*:', line):
+            in_wallet = True
+        elif in_wallet and not re.match('^(\s|#|-|$)', line):
+            in_wallet = False
+        (wallet if in_wallet else rest).append(line)
+
+    return ''.join(rest), ''.join(wallet)
+
+
+# bump when the snapshot layout changes
+snapshot_version = 1
+
+
+# load the config file. A compiled snapshot keyed by the file's mtime,
+# size and hash is used when it's current, otherwise the YAML is parsed
+# and a new snapshot written. The wallet section stays serialized until
+# it's first accessed.
+def load_config(path):
+
+    snapshot_path = path + '.snapshot'
+    stat = os.stat(path)
+    snapshot = None
+    try:
+        with open(snapshot_path, 'rb') as stream:
+            snapshot = marshal.load(stream)
+    except Exception:
+        pass
+
+    if not isinstance(snapshot, dict) or snapshot.get('version') != snapshot_version:
+        snapshot = None
+
+    # fast path, file unchanged since the snapshot
+    if snapshot is not None and snapshot['mtime'] == stat.st_mtime and snapshot['size'] == stat.st_size:
+        return snapshot_config(snapshot)
+
+    with open(path, 'rb') as stream:
+        text = stream.read()
+    digest = hashlib.sha1(text).hexdigest()
+
+    # touched but unchanged
+    if snapshot is not None and snapshot['hash'] == digest:
+        write_config_snapshot(snapshot_path, dict(snapshot, mtime=stat.st_mtime, size=stat.st_size))
+        return snapshot_config(snapshot)
+
+    rest, wallet_text = split_wallet_section(text)
+    values = yaml.load(rest, Loader=yaml_loader()) or {}
+    wallet = (yaml.load(wallet_text, Loader=yaml_loader()) or {}).get('wallet') if wallet_text else None
+
+    try:
+        write_config_snapshot(snapshot_path, { 'version' : snapshot_version, 'mtime' : stat.st_mtime, 'size' : stat.st_size, 'hash' : digest,
+                                               'config' : values, 'wallet' : marshal.dumps(wallet) if wallet_text else None })
+    except ValueError as e:
+        logger.debug('Config can\'t be snapshotted: {}'.format(e))
+
+    config = Config(values)
+    if wallet_text:
+        config['wallet'] = wallet
+    return config
+
+
+def snapshot_config(snapshot):
+    wallet = snapshot['wallet']
+    if wallet is None:
+        return Config(snapshot['config'])
+    return Config(snapshot['config'], lambda: marshal.loads(wallet))
+
+
+# write a snapshot readable only by the owner since it holds private keys
+def write_config_snapshot(path, snapshot):
+
+    data = marshal.dumps(snapshot)
+    tmp = '{}.{}'.format(path, os.getpid())
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as stream:
+            stream.write(data)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        logger.debug('Unable to write config snapshot {}: {}'.format(path, e))
+
+
 # load config
-config = None
 config_file = os.path.expanduser('~/.basic-wallet.conf')
-with open(config_file, 'r') as stream:
-    config = yaml.load(stream)
+config = load_config(config_file)
+
+
+# When the wallet daemon (walletd.py) is listening on daemon-socket,
+# functions marked with @daemon_method are forwarded to it and answered
+# from its warm caches. Inside the daemon they run locally.
+daemon_methods = {}
+daemon_state = { 'serving' : False, 'available' : None }
+no_daemon = object()
+
+
+def get_daemon_socket():
+    return os.path.expanduser(config.get('daemon-socket', '~/.basic-wallet.sock'))
+
+
+# call a method in the daemon, returns its result or no_daemon if the
+# daemon isn't running or the call failed
+def daemon_call(method, args, kwargs):
+
+    if daemon_state['available'] is False:
+        return no_daemon
+
+    path = get_daemon_socket()
+    if not os.path.exists(path):
+        daemon_state['available'] = False
+        return no_daemon
+
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(config.get('daemon-timeout', 300))
+    try:
+        client.connect(path)
+        client.sendall(json.dumps({ 'method' : method, 'args' : args, 'kwargs' : kwargs }) + '\n')
+        reply = json.loads(client.makefile('r').readline())
+    except (socket.error, ValueError) as e:
+        logger.warning('Wallet daemon call {} failed, running locally: {}'.format(method, e))
+        daemon_state['available'] = False
+        return no_daemon
+    finally:
+        client.close()
+
+    daemon_state['available'] = True
+    if 'error' in reply:
+        logger.warning('Wallet daemon call {} failed, running locally: {}'.format(method, reply['error']))
+        return no_daemon
+
+    logger.debug('Wallet daemon answered {}'.format(method))
+    return reply['result']
+
+
+# forward calls to the wallet daemon when one is running
+def daemon_method(func):
 
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not daemon_state['serving']:
+            result = daemon_call(func.__name__, args, kwargs)
+            if result is not no_daemon:
+                return result
+        return func(*args, **kwargs)
 
-# retrieve and validate all wallet addresses
+    daemon_methods[func.__name__] = wrapper
+    return wrapper
+
+
+# shared HTTP session with pooled keep-alive connections
+session = None
+session_lock = threading.Lock()
+
+def get_session():
+    global session
+
+    with session_lock:
+        if session is None:
+            pool_size = config.get('http-pool-size', 10)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            logger.debug('HTTP session created with pool size {}'.format(pool_size))
+
+    return session
+
+
+# (connect, read) timeouts in seconds for every HTTP request
+def get_timeout():
+    return (config.get('http-connect-timeout', 5), config.get('http-read-timeout', 30))
+
+
+# retrieve and validate all wallet addresses, parsed once per process
 def get_wallet():
+    return list(get_wallet_index()['wallet'])
+
+
+# parse and validate the wallet section of the config
+def load_wallet():
     n = 0
     wallet = []
+    valid = validate_addresses([item['address'] for item in config['wallet'] if 'address' in item])
 
     for item in config['wallet']:
         n += 1
@@ -45,7 +266,7 @@ def get_wallet():
             logger.error('Wallet address #{} is misconfigured: {}'.format(n, str(item)))
             continue
 
-        if not validate_address(address):
+        if not valid[address]:
             logger.warning('{} address {} is not a valid Bitcoin address'.format(name, address))
 
         wallet.append( {'name' : name, 'address' : address, 'privkey' : privkey, 'active' : active } )
@@ -53,16 +274,75 @@ def get_wallet():
     return sorted(wallet, key=lambda k: k['name'])
 
 
+# wallet lookup index, rebuilt only when config['wallet'] is replaced
+wallet_index = { 'source' : None }
+wallet_index_lock = threading.Lock()
+ngram_size = 3
+
+
+def ngrams(text):
+    return set([text[i:i+ngram_size] for i in range(len(text) - ngram_size + 1)])
+
+
+# return the wallet with exact address and name maps and an n-gram
+# index over lowercase names and addresses
+def get_wallet_index():
+
+    with wallet_index_lock:
+        if wallet_index['source'] is not config['wallet']:
+            wallet = load_wallet()
+            by_address = {}
+            by_name = {}
+            grams = {}
+
+            for pos, item in enumerate(wallet):
+                by_address[item['address'].lower()] = pos
+                by_name.setdefault(item['name'].lower(), []).append(pos)
+                for gram in ngrams(item['name'].lower()) | ngrams(item['address'].lower()):
+                    grams.setdefault(gram, set()).add(pos)
+
+            wallet_index.update({ 'source' : config['wallet'], 'wallet' : wallet, 'by_address' : by_address,
+                                  'by_name' : by_name, 'grams' : grams })
+            logger.debug('Indexed {} wallet entr{}'.format(len(wallet), 'y' if len(wallet) == 1 else 'ies'))
+
+    return wallet_index
+
+
+# return wallet entries whose name or address contains search_string
+def search_wallet(search_string):
+
+    index = get_wallet_index()
+    wallet = index['wallet']
+    search = search_string.lower()
+
+    if search in index['by_address']:
+        return [ wallet[index['by_address'][search]] ]
+
+    # candidates share every n-gram of the search string
+    candidates = range(len(wallet))
+    if len(search) >= ngram_size:
+        sets = sorted([index['grams'].get(gram, set()) for gram in ngrams(search)], key=len)
+        candidates = sorted(set.intersection(*sets))
+
+    hits = []
+    for pos in candidates:
+        item = wallet[pos]
+        if search in item['name'].lower() or search in item['address'].lower():
+            hits.append(item)
+
+    # an exact name match wins over other substring matches
+    if len(hits) > 1 and len(index['by_name'].get(search, [])) == 1:
+        return [ wallet[index['by_name'][search][0]] ]
+
+    return hits
+
+
 # find a wallet address by substring match
 def lookup(search_string):
-    hits = []
-    wallet = get_wallet()
+    hits = search_wallet(search_string)
 
-    for item in wallet:
-        if search_string.lower() in item['name'].lower() or \
-           search_string.lower() in item['address'].lower():
-            hits.append(item)
-            logger.debug('search string "{}" matched wallet entry: {}'.format(search_string.upper(), item))
+    for item in hits:
+        logger.debug('search string "{}" matched wallet entry: {}'.format(search_string.upper(), item))
 
     # there can be only one unique matching address
     n = len(hits)
@@ -81,16 +361,157 @@ def lookup(search_string):
         exit(1)
 
 
-# convert URL to a unique local filesystem path
-def get_cache_path(url):
+# status codes the API uses to signal too many requests
+throttle_statuses = (429, 438)
+
+
+# return the HTTP status, or the status carried in a JSON body when
+# the API reports throttling with a 200 response
+def response_status(response):
+
+    status = response.status_code
+    body = response.text.strip()
+    if status == 200 and body.startswith('{') and '"status"' in body:
+        try:
+            inner = int(json.loads(body)['status'])
+            if inner in throttle_statuses:
+                return inner
+        except:
+            pass
+
+    return status
+
+
+# token bucket shared by all requests. The rate starts at rate-limit
+# requests per second, halves whenever the API throttles us and creeps
+# back up on success, settling near the sustainable rate.
+rate_limiter = { 'rate' : None, 'tokens' : 0.0, 'time' : 0.0 }
+rate_lock = threading.Lock()
+
+
+def acquire_token():
+
+    while True:
+        with rate_lock:
+            now = time.time()
+            if rate_limiter['rate'] is None:
+                rate_limiter['rate'] = float(config.get('rate-limit', 10))
+                rate_limiter['tokens'] = rate_limiter['rate']
+                rate_limiter['time'] = now
+
+            rate = rate_limiter['rate']
+            elapsed = now - rate_limiter['time']
+            rate_limiter['tokens'] = min(max(rate, 1.0), rate_limiter['tokens'] + elapsed * rate)
+            rate_limiter['time'] = now
+
+            if rate_limiter['tokens'] >= 1.0:
+                rate_limiter['tokens'] -= 1.0
+                return
+            wait = (1.0 - rate_limiter['tokens']) / rate
+
+        time.sleep(wait)
+
+
+# adjust the request rate after a response
+def adapt_rate(throttled):
+
+    with rate_lock:
+        rate = rate_limiter['rate'] or float(config.get('rate-limit', 10))
+        if throttled:
+            rate = max(config.get('rate-limit-min', 0.5), rate / 2.0)
+            rate_limiter['tokens'] = 0.0
+            logger.warning('API is throttling requests, slowing down to {:.2f}/s'.format(rate))
+        else:
+            rate = min(float(config.get('rate-limit', 10)), rate + 0.1)
+        rate_limiter['rate'] = rate
+
+
+# seconds to wait before retry attempt n with jittered exponential backoff
+def backoff_delay(attempt, response=None):
+
+    if response is not None and response.headers.get('Retry-After', '').isdigit():
+        return float(response.headers['Retry-After'])
+
+    base = config.get('retry-backoff', 1.0)
+    return min(60.0, base * (2 ** attempt)) * random.uniform(0.5, 1.5)
+
+
+# rate limited HTTP request with retries, returns the response or None.
+# GETs are retried on network errors and server errors, POSTs only when
+# throttled since the server didn't process them.
+def http_request(method, url, **kwargs):
+
+    retries = kwargs.pop('retries', config.get('max-retries', 5))
+    timeout = kwargs.pop('timeout', get_timeout())
+
+    for attempt in range(retries + 1):
+        acquire_token()
+        response = None
+        logger.debug('{} {}'.format(method, url))
+
+        try:
+            response = get_session().request(method, url, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            if method != 'GET' or attempt == retries:
+                logger.error('Request failed: {}'.format(e))
+                return None
+            logger.warning('Request failed, retrying: {}'.format(e))
+            time.sleep(backoff_delay(attempt))
+            continue
+
+        status = response_status(response)
+        throttled = status in throttle_statuses
+        adapt_rate(throttled)
+
+        retryable = throttled or (method == 'GET' and status in (500, 502, 503, 504))
+        if not retryable or attempt == retries:
+            return response
+
+        delay = backoff_delay(attempt, response)
+        logger.warning('{} responded with status code {}, retrying in {:.1f}s'.format(url, status, delay))
+        time.sleep(delay)
+
+    return response
+
+
+# Berkeley DB files opened without an environment can't be shared
+# between processes: each keeps its own page cache and writes aren't
+# locked. So every use opens the database under an flock of a lock
+# file next to it and closes it before unlocking, readers share the
+# lock. A missing database is created under the exclusive lock.
+@contextlib.contextmanager
+def open_db(opener, path, exclusive=False):
+    with open(path + '.lock', 'a') as lock:
+        exclusive = exclusive or not os.path.exists(path)
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        db = opener(path, 'c' if exclusive else 'r')
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+# response cache, a single embedded key-value store in cache-dir
+cache_lock = threading.Lock()
+cache_size_key = '__size__'
+
+
+# return the cache database path or None if caching is disabled
+def get_cache_path():
 
     if 'cache-dir' not in config.keys() or \
        config['cache-dir'] is None or \
        len(config['cache-dir'].strip()) == 0:
         return None
 
-    if not os.path.exists(config['cache-dir']):
-        os.makedirs(config['cache-dir'])
+    path = os.path.join(os.path.expanduser(config['cache-dir']), 'cache.db')
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    return path
+
+
+# convert URL to a unique cache key or None if the URL is invalid
+def get_cache_key(url):
 
     match = re.match('^(.*:)//([A-Za-z0-9\-\.]+)(:[0-9]+)?(.*)$', url)
     if (match is None):
@@ -98,65 +519,156 @@ def get_cache_path(url):
         return None
 
     g = match.groups()
-    cache_file = g[1] + '-' + g[3]
-    cache_file = re.sub('[=?/.]', '-', cache_file)
-    cache_file = re.sub('-+', '-', cache_file)
-    cache_path = config['cache-dir'] + '/' + cache_file
+    return g[1] + g[3]
+
+
+# return cache entry with body, fetch time, status, size and last use or None
+def cache_get(url):
+
+    key = get_cache_key(url)
+    if key is None:
+        return None
+
+    path = get_cache_path()
+    if path is None:
+        return None
+
+    with cache_lock, open_db(bsddb.hashopen, path, True) as db:
+        if not db.has_key(key):
+            return None
+
+        entry = json.loads(db[key])
+        entry['used'] = time.time()
+        db[key] = json.dumps(entry)
+
+    return entry
+
 
-    return cache_path
+# store a response in the cache and evict old entries if it's full,
+# permanent entries are never evicted and don't count toward the limit
+def cache_put(url, body, status, permanent=False):
 
+    key = get_cache_key(url)
+    if key is None:
+        return
 
-# return the response from a URL get or None
-def url_get(url, use_cache=False):
+    entry = { 'body' : body, 'status' : status, 'size' : len(body), 'time' : time.time(), 'permanent' : permanent }
+    entry['used'] = entry['time']
+
+    path = get_cache_path()
+    if path is None:
+        return
+
+    with cache_lock, open_db(bsddb.hashopen, path, True) as db:
+        total = int(db[cache_size_key]) if db.has_key(cache_size_key) else 0
+        if db.has_key(key):
+            old = json.loads(db[key])
+            if not old.get('permanent'):
+                total -= old['size']
+        db[key] = json.dumps(entry)
+        if not permanent:
+            total += entry['size']
+        db[cache_size_key] = str(total)
+
+        limit = config.get('cache-max-bytes', 64 * 1024 * 1024)
+        if total > limit:
+            cache_evict(db, total, limit)
+
+
+# delete least recently used entries until the cache is 90% of its limit
+def cache_evict(db, total, limit):
+
+    entries = []
+    for key in db.keys():
+        if key != cache_size_key:
+            entry = json.loads(db[key])
+            if not entry.get('permanent'):
+                entries.append((entry['used'], key, entry['size']))
+
+    n = 0
+    for used, key, size in sorted(entries):
+        if total <= limit * 0.9:
+            break
+        del db[key]
+        total -= size
+        n += 1
+
+    db[cache_size_key] = str(total)
+    logger.debug('Evicted {} cache entr{}, {:,} bytes remain'.format(n, 'y' if n == 1 else 'ies', total))
+
+
+# return the response from a URL get or None. If is_immutable is given
+# it's called with the response and a True result stores it permanently,
+# later gets are then answered from the cache without a network call.
+def url_get(url, use_cache=False, is_immutable=None, max_age=None):
 
     html = None
-    cache_path = get_cache_path(url)
 
-    if (config['networking-enabled']) and (use_cache==False):
+    if max_age is not None and use_cache == False:
         try:
-            logger.debug('GET {}'.format(url))
-            response = requests.get(url)
-        except requests.exceptions.RequestException as e:
-            logger.error('Request failed: {}'.format(e))
+            entry = cache_get(url)
+        except Exception as e:
+            logger.error('Unable to read cache entry: {}'.format(e))
+            entry = None
+
+        if entry is not None and entry['status'] == 200 and time.time() - entry['time'] < max_age:
+            logger.debug('Loaded cached data for {} from {:.0f}s ago'.format(url, time.time() - entry['time']))
+            return str(entry['body'])
+
+    if is_immutable is not None:
+        try:
+            entry = cache_get(url)
+        except Exception as e:
+            logger.error('Unable to read cache entry: {}'.format(e))
+            entry = None
+
+        if entry is not None and entry.get('permanent') and entry['status'] == 200:
+            logger.debug('Loaded permanent cached data for {}'.format(url))
+            return str(entry['body'])
+
+    if (config['networking-enabled']) and (use_cache==False):
+        response = http_request('GET', url)
+        if response is None:
             return None
 
         html = response.text.strip()
         clean = filter(lambda x: x in string.printable, html)
         logger.debug('RESPONSE {}'.format(clean))
 
-        if cache_path is not None:
-
-            try:
-                logger.debug('CACHING data to {}'.format(cache_path))
-                with open(cache_path, 'w') as cache:
-                    cache.write(clean)
+        status = response_status(response)
+        permanent = (status == 200) and (is_immutable is not None) and is_immutable(clean)
+        try:
+            cache_put(url, clean, status, permanent)
+        except Exception as e:
+            logger.error('Unable to write cache entry: {}'.format(e))
 
-            except Exception as e:
-                logger.error('Unable to write cache file: {}'.format(e))
-        
-            status = response.status_code
-            if (status != 200):
-                logger.error('{} responded with status code {}'.format(url, status))
-                return None
+        if (status != 200):
+            logger.error('{} responded with status code {}'.format(url, status))
+            return None
 
     # use cache
     else:
-        if cache_path is None:
-            logger.error('URL get failed: networking disabled and cache unavailable')
+        try:
+            entry = cache_get(url)
+        except Exception as e:
+            logger.error('Unable to read cache entry: {}'.format(e))
             return None
-        else:
-            try:
-                logger.debug('Loading cached data from {}'.format(cache_path))
-                with open(cache_path) as cache:
-                    html = cache.read()
-            except:
-                logger.error('Unable to read cache {}'.format(cache_path))
-                return None
-            
+
+        if entry is None:
+            logger.error('URL get failed: networking disabled and no cached response for {}'.format(url))
+            return None
+
+        logger.debug('Loaded cached data for {} fetched {}'.format(url, datetime.datetime.fromtimestamp(entry['time'])))
+        if (entry['status'] != 200):
+            logger.error('{} cached response has status code {}'.format(url, entry['status']))
+            return None
+        html = str(entry['body'])
+
     return html
 
 
 # return current balance for address in satoshis or None
+@daemon_method
 def get_balance(address, use_cache=False):
 
     request = '{}/addr/{}/balance'.format(config['api-url'], address)
@@ -171,8 +683,139 @@ def get_balance(address, use_cache=False):
     return balance
 
 
-# broadcast a transaction to the Bitcoin network, return TXID or None
-def broadcast(tx_hex):
+# apply func to every item using a thread pool, results in input order
+def map_concurrent(func, items, threads=None):
+
+    if threads is None:
+        threads = config.get('fetch-threads', 8)
+
+    if threads <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    logger.debug('Fetching {} item{} using {} threads'.format(len(items), pluralize(len(items)), threads))
+    if threads == config.get('fetch-threads', 8):
+        return get_fetch_pool().map(func, items)
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(threads, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# shared worker pool for concurrent fetches. The pool size bounds the
+# number of requests in flight, extra submissions wait in its queue.
+fetch_pool = None
+fetch_pool_lock = threading.Lock()
+
+def get_fetch_pool():
+    global fetch_pool
+
+    with fetch_pool_lock:
+        if fetch_pool is None:
+            threads = max(1, config.get('fetch-threads', 8))
+            from multiprocessing.pool import ThreadPool
+            fetch_pool = ThreadPool(threads)
+            logger.debug('Fetch pool created with {} threads'.format(threads))
+
+    return fetch_pool
+
+
+def close_fetch_pool():
+    global fetch_pool
+
+    if fetch_pool is not None:
+        fetch_pool.terminate()
+    fetch_pool = None
+
+atexit.register(close_fetch_pool)
+
+
+# run func(*args) on the fetch pool, returns an AsyncResult whose get()
+# waits for and returns the result. Tasks must not wait on other tasks.
+def submit(func, *args):
+    return get_fetch_pool().apply_async(func, args)
+
+
+# async variants of the network calls, the sync functions remain the
+# implementation so both return the same results
+def url_get_async(url, use_cache=False, is_immutable=None):
+    return submit(url_get, url, use_cache, is_immutable)
+
+def get_balance_async(address, use_cache=False):
+    return submit(get_balance, address, use_cache)
+
+def get_unspent_async(address):
+    return submit(get_unspent, address)
+
+
+# split a list into chunks of at most size items
+def chunked(items, size):
+    size = max(1, size)
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+# return raw UTXO records for many addresses as a dict keyed by
+# address using the multi-address endpoint, or None
+def fetch_unspent(addresses, use_cache=False, threads=None):
+
+    def fetch_chunk(chunk):
+        url = '{}/addrs/{}/utxo'.format(config['api-url'], ','.join(chunk))
+        html = url_get(url, use_cache)
+        try:
+            return json.loads(html)
+        except:
+            logger.error('Couldn\'t parse UTXO JSON data {} '.format(html))
+            return None
+
+    chunks = chunked(addresses, config.get('batch-size', 20))
+    result = dict((address, []) for address in addresses)
+
+    for utxos in map_concurrent(fetch_chunk, chunks, threads):
+        if utxos is None:
+            return None
+        for tx in utxos:
+            if tx.get('address') not in result:
+                logger.warning('Ignoring UTXO for unrequested address {}'.format(tx.get('address')))
+                continue
+            result[tx['address']].append(tx)
+
+    return result
+
+
+# return balances for many addresses in the same order, fetched concurrently
+@daemon_method
+def get_balances(addresses, use_cache=False, threads=None):
+
+    # one request per address
+    if config.get('batch-size', 20) <= 1:
+        return map_concurrent(lambda address: get_balance(address, use_cache), addresses, threads)
+
+    # batched requests, balance is the sum of confirmed UTXOs
+    utxos = fetch_unspent(addresses, use_cache, threads)
+    if utxos is None:
+        return [None] * len(addresses)
+
+    balances = []
+    for address in addresses:
+        try:
+            balance = sum([int(tx['satoshis']) for tx in utxos[address] if int(tx['confirmations']) > 0])
+        except:
+            logger.error('Couldn\'t parse UTXO attributes for {}'.format(address))
+            balance = None
+        balances.append(balance)
+
+    return balances
+
+
+# Push a transaction to the Bitcoin network. Returns (TXID or None,
+# rejected) where rejected is True only if the transaction certainly
+# wasn't accepted, a 4xx reply other than throttling. A request that
+# failed, timed out, was throttled or got a 5xx from a proxy may still
+# have reached the network.
+def send_tx(tx_hex):
 
     url = '{}/tx/send'.format(config['api-url'])
     payload = { 'rawtx' : tx_hex }
@@ -180,19 +823,21 @@ def broadcast(tx_hex):
 
     if (not config['networking-enabled']):
         logger.info('Skipping pushtx because network disabled')
-        return None
+        return None, True
 
-    logger.debug('POST {}'.format(url))
     logger.debug('PAYLOAD {}'.format(payload))
-    response = requests.post(url, data=payload)
+    response = http_request('POST', url, data=payload)
+    if response is None:
+        return None, False
+
     html = response.text.strip()
     clean = filter(lambda x: x in string.printable, html)
     logger.debug('RESPONSE {}'.format(clean))
 
-    status = response.status_code
+    status = response_status(response)
     if (status != 200):
         logger.error('{} responded with status code {}'.format(url, status))
-        return None
+        return None, 400 <= status < 500 and status not in throttle_statuses
 
     try:
         j = json.loads(html)
@@ -200,14 +845,32 @@ def broadcast(tx_hex):
 
     except:
         logger.error('Couldn\'t parse transaction JSON data {} '.format(html))
-        return None
+        return None, False
+
+    return tid, False
+
+
+# broadcast a transaction to the Bitcoin network, return TXID or None
+def broadcast(tx_hex):
+    return send_tx(tx_hex)[0]
+
+# latest spot quote, reused for price-ttl seconds in process and from
+# the response cache on disk
+price_quote = { 'price' : None, 'time' : 0 }
+price_lock = threading.RLock()
 
-    return tid
 
 # return latest BTC price in USD or None
+@daemon_method
 def get_bitcoin_price(use_cache=False):
 
-    html = url_get('{}/currency'.format(config['api-url']), use_cache)
+    ttl = config.get('price-ttl', 60)
+    with price_lock:
+        if not use_cache and price_quote['price'] is not None and time.time() - price_quote['time'] < ttl:
+            logger.debug('Reusing bitcoin price ${:,.2f}'.format(price_quote['price']))
+            return price_quote['price']
+
+    html = url_get('{}/currency'.format(config['api-url']), use_cache, max_age=ttl)
     try:
         quote = json.loads(html)
 
@@ -215,6 +878,15 @@ def get_bitcoin_price(use_cache=False):
         logger.error('Couldn\'t parse JSON: {}'.format(html))
         return None
 
+    # the response carries its own status e.g.
+    # {
+    #   "status": 438,
+    #   "error": "Too many requests"
+    #   }
+    if isinstance(quote, dict) and quote.get('status', 200) != 200:
+        logger.error('Price quote responded with status {}: {}'.format(quote.get('status'), quote.get('error')))
+        return None
+
     try:
         price = float(quote['data']['bitstamp'])
 
@@ -223,20 +895,101 @@ def get_bitcoin_price(use_cache=False):
         logger.error('{} {}'.format(except_name, e))
         return None
 
-    # todo: handle various statuses in response e.g.
-    # {
-    #   "status": 438,
-    #   "error": "Too many requests"
-    #   }
+    with price_lock:
+        price_quote.update({ 'price' : price, 'time' : time.time() })
+    record_price(time.time(), price)
 
     logger.info('Latest bitcoin price is ${:,.2f}'.format(price))
     return price
 
 
+# Local price history: (unix time, USD price) pairs stored as a flat
+# array of doubles in price-history-file. Spot quotes are appended at
+# most every price-history-interval seconds and lookups bisect the
+# in-memory copy, so valuing old transactions needs no network.
+price_history = { 'path' : None, 'times' : None, 'prices' : None }
+price_history_gap = 7 * 24 * 3600
+
+
+def get_price_history_path():
+    return os.path.expanduser(config.get('price-history-file', '~/.basic-wallet-prices'))
+
+
+# load the history once per process, returns the price_history dict
+def load_price_history():
+
+    with price_lock:
+        path = get_price_history_path()
+        if price_history['path'] == path:
+            return price_history
+
+        data = array.array('d')
+        if os.path.isfile(path):
+            with open(path, 'rb') as pfile:
+                n = os.path.getsize(path) // data.itemsize
+                data.fromfile(pfile, n - n % 2)
+
+        pairs = sorted(zip(data[0::2], data[1::2]))
+        price_history.update({ 'path' : path,
+                               'times' : array.array('d', [t for (t, p) in pairs]),
+                               'prices' : array.array('d', [p for (t, p) in pairs]) })
+        logger.debug('Loaded {} price sample{}'.format(len(pairs), pluralize(len(pairs))))
+
+    return price_history
+
+
+# append price samples [(unix time, USD price), ...] to the history
+def add_prices(samples):
+
+    with price_lock:
+        history = load_price_history()
+        data = array.array('d')
+        for (t, p) in samples:
+            i = bisect.bisect(history['times'], t)
+            history['times'].insert(i, t)
+            history['prices'].insert(i, p)
+            data.extend([t, p])
+
+        try:
+            with open(history['path'], 'ab') as pfile:
+                os.chmod(history['path'], 0o600)
+                data.tofile(pfile)
+        except IOError as e:
+            logger.error('Unable to write price history {}: {}'.format(history['path'], e))
+
+
+# record a spot quote unless the last sample is recent
+def record_price(t, price):
+
+    with price_lock:
+        history = load_price_history()
+        times = history['times']
+        if len(times) and t - times[-1] < config.get('price-history-interval', 3600):
+            return
+        add_prices([(t, price)])
+
+
+# USD price nearest to unix time t, or None if the history has no
+# sample within a week of it
+def price_at(t):
+
+    with price_lock:
+        history = load_price_history()
+        times = history['times']
+        i = bisect.bisect(times, t)
+        nearest = [j for j in (i - 1, i) if 0 <= j < len(times)]
+        if not nearest:
+            return None
+        j = min(nearest, key=lambda k: abs(times[k] - t))
+        if abs(times[j] - t) > price_history_gap:
+            return None
+        return history['prices'][j]
+
+
 # returns confirmed UTXOs for an address or None
+@daemon_method
 def get_unspent(address):
 
-    result = []
     url = '{}/addr/{}/utxo'.format(config['api-url'], address)
     html = url_get(url)
 
@@ -246,6 +999,32 @@ def get_unspent(address):
         logger.error('Couldn\'t parse transaction JSON data {} '.format(html))
         return None
 
+    return parse_unspent(address, utxo)
+
+
+# returns confirmed UTXOs for many addresses as a dict keyed by address
+# using batched requests, or None
+@daemon_method
+def get_unspent_many(addresses):
+
+    utxos = fetch_unspent(addresses)
+    if utxos is None:
+        return None
+
+    result = {}
+    for address in addresses:
+        result[address] = parse_unspent(address, utxos[address])
+        if result[address] is None:
+            return None
+
+    return result
+
+
+# convert raw UTXO records to id, vout and amount or None
+def parse_unspent(address, utxo):
+
+    result = []
+
     try:
         for tx in utxo:
             txinfo = {}
@@ -271,11 +1050,11 @@ def get_unspent(address):
     return result
 
 
-# returns transactions for an address or None
+# returns transactions for an address or None, the local ledger is
+# synced first when networking is enabled
+@daemon_method
 def get_transactions(address):
 
-    txsum = {}
-    txdt = {}
     results = []
     memos = load_memos()
 
@@ -285,113 +1064,649 @@ def get_transactions(address):
     for item in wallet:
         names[item['address']] = item['name']
 
-    # get all tx for this address
-    url = '{}/addr/{}'.format(config['api-url'], address)
-    html = url_get(url)
-    addrinfo = json.loads(html)
-    txs = addrinfo['transactions']
+    if config['networking-enabled'] and not sync_ledger(address):
+        logger.error('Unable to sync transactions for {}'.format(address))
+        return None
 
-    # fetch details on each
-    for tx in txs:
-        url = '{}/tx/{}'.format(config['api-url'], tx)
-        html = url_get(url)
-        txinfo = json.loads(html)
+    with ledger_lock, open_ledger() as db:
+        records = ledger_records(db, address)
 
-        id = txinfo['txid']
-        confs = txinfo['confirmations']
+    for rec in sorted(records.values(), key=lambda k: k['date']):
+        id = rec['id']
+        confs = rec['confirmations']
         if (confs < config['min-confirmations']):
             logger.warning('Ignoring TX {} ({} confirmation{})'.format(id, confs, pluralize(confs)))
             continue
 
-        ts = int(txinfo['blocktime'])
-        dt = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
-
-        vins = txinfo['vin']
-        for vin in vins:
-            val = float(vin['value'])
-            addr = vin['addr']
-            if (addr == address):
-                if id in txsum.keys():
-                    txsum[id] -= val
-                else:
-                    txsum[id] = -val
-                    txdt[id] = dt
-
-        vouts = txinfo['vout']
-        for vout in vouts:
-            val = float(vout['value'])
-            addrs = vout['scriptPubKey']['addresses']
-            assert len(addrs) == 1
-            if (addrs[0] == address):
-                if id in txsum.keys():
-                    txsum[id] += val
-                else:
-                    txsum[id] = val
-                    txdt[id] = dt
-
-    for id in sorted(txdt.keys(), key=lambda k: txdt[k]):
         txt = names[address]
         if id[:16] in memos.keys():
             txt = memos[id[:16]]
-        rec = {}
-        rec['id'] = id
-        rec['date'] = txdt[id]
-        rec['amount'] = txsum[id]
-        rec['memo'] = txt
-        results.append(rec)
+        results.append({ 'id' : id, 'date' : rec['date'], 'amount' : rec['amount'], 'memo' : txt })
 
     return results
 
 
+# summarize a full tx object as seen by one address or None if the
+# address isn't involved
+def summarize_tx(txinfo, address):
+
+    amount = None
+    counterparties = set()
+
+    vins = txinfo['vin']
+    for vin in vins:
+        if (vin.get('addr') == address):
+            amount = (amount or 0.0) - float(vin['value'])
+        elif vin.get('addr'):
+            counterparties.add(vin['addr'])
+
+    vouts = txinfo['vout']
+    for vout in vouts:
+        addrs = vout['scriptPubKey']['addresses']
+        assert len(addrs) == 1
+        if (addrs[0] == address):
+            amount = (amount or 0.0) + float(vout['value'])
+        else:
+            counterparties.add(addrs[0])
+
+    if amount is None:
+        return None
+
+    rec = {}
+    rec['id'] = txinfo['txid']
+    rec['amount'] = amount
+    rec['confirmations'] = int(txinfo['confirmations'])
+    rec['height'] = int(txinfo.get('blockheight', -1))
+    rec['counterparties'] = sorted(counterparties)
+    ts = int(txinfo.get('blocktime', time.time()))
+    rec['date'] = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+    return rec
+
+
+# local transaction ledger, a btree database keyed by address and txid.
+# Addresses synced with an older ledger_version are synced from scratch.
+ledger_version = 2
+ledger_lock = threading.Lock()
+
+
+# open the ledger database for one read, or write when exclusive
+def open_ledger(exclusive=False):
+    path = os.path.expanduser(config.get('ledger-file', '~/.basic-wallet-ledger'))
+    return open_db(bsddb.btopen, path, exclusive)
+
+
+# return all ledger records for an address keyed by txid
+def ledger_records(db, address):
+
+    records = {}
+    prefix = 'tx/{}/'.format(address)
+    try:
+        key, value = db.set_location(prefix)
+        while key.startswith(prefix):
+            records[key[len(prefix):]] = json.loads(value)
+            key, value = db.next()
+    except KeyError:
+        pass
+
+    return records
+
+
+# fetch transactions newer than the address watermark into the ledger,
+# returns True on success. The watermark is the highest block of a
+# final tx, everything at or below it is already in the ledger.
+def sync_ledger(address):
+
+    final = config.get('final-confirmations', 6)
+
+    with ledger_lock, open_ledger(True) as db:
+        mark_key = 'mark/{}'.format(address)
+        mark = json.loads(db[mark_key]) if db.has_key(mark_key) else { 'height' : -1 }
+        if mark.get('version', 1) != ledger_version:
+            mark = { 'height' : -1 }
+        known = ledger_records(db, address)
+
+        seen = set()
+        height = mark['height']
+        added = 0
+        txs = iter_address_txs(address)
+        for txinfo in txs:
+
+            if txinfo is None:
+                return False
+
+            confs = int(txinfo['confirmations'])
+            txheight = int(txinfo.get('blockheight', -1))
+            if confs >= final and 0 <= txheight <= mark['height']:
+                break
+
+            rec = summarize_tx(txinfo, address)
+            if rec is None:
+                continue
+
+            seen.add(rec['id'])
+            if rec['id'] not in known:
+                added += 1
+            db['tx/{}/{}'.format(address, rec['id'])] = json.dumps(rec)
+            if confs >= final:
+                height = max(height, txheight)
+
+        # stop fetching pages, a plain iterator has nothing to close
+        close = getattr(txs, 'close', None)
+        if close is not None:
+            close()
+
+        # drop shallow tx that are no longer reported, e.g. double spends
+        for txid, rec in known.items():
+            if rec['confirmations'] < final and txid not in seen:
+                logger.warning('Removing vanished TX {} from ledger'.format(txid))
+                del db['tx/{}/{}'.format(address, txid)]
+
+        db[mark_key] = json.dumps({ 'height' : height, 'synced' : time.time(), 'version' : ledger_version })
+
+    logger.debug('Synced {} new transaction{} for {} up to block {}'.format(added, pluralize(added), address, height))
+    return True
+
+
+# fetch one page of full tx objects for an address or None
+def get_tx_page(address, page):
+
+    url = '{}/txs?address={}&pageNum={}'.format(config['api-url'], address, page)
+    html = url_get(url)
+    try:
+        result = json.loads(html)
+        txs = result['txs']
+        pages = int(result['pagesTotal'])
+    except:
+        logger.error('Couldn\'t parse transaction page JSON data {} '.format(html))
+        return None
+
+    return { 'txs' : txs, 'pagesTotal' : pages }
+
+
+# yield every full tx object for an address, the next page is fetched
+# in the background while the current one is processed. Yields None
+# and stops if a page can't be fetched.
+def iter_address_txs(address):
+
+    page = 0
+    pending = submit(get_tx_page, address, page)
+
+    while pending is not None:
+        result = pending.get()
+        if result is None:
+            yield None
+            return
+
+        page += 1
+        pages = int(result['pagesTotal'])
+        logger.debug('Fetched transaction page {} of {} for {}'.format(page, pages, address))
+
+        pending = None
+        if page < pages:
+            pending = submit(get_tx_page, address, page)
+
+        for txinfo in result['txs']:
+            yield txinfo
+
+
+# true if a tx JSON response is buried deep enough to never change
+def tx_is_final(html):
+    try:
+        confs = int(json.loads(html)['confirmations'])
+    except:
+        return False
+    return confs >= config.get('final-confirmations', 6)
+
+
 def pluralize(amount):
     return '' if (amount == 1) else 's'
 
 
+# Memos live in an append-only log, one JSON record per line. Adding a
+# memo appends a line, later records for the same 16 char txid prefix
+# win. The in-process index only reads lines appended since it was
+# last refreshed, and the log is compacted when it's mostly stale.
+memo_index = { 'path' : None, 'inode' : None, 'offset' : 0, 'records' : 0, 'memos' : {} }
+memo_lock = threading.RLock()
+memo_file_lock = { 'file' : None, 'depth' : 0 }
+
+
+# Hold the memo log against other processes appending or compacting it,
+# a memo appended while another process compacts would be lost. Nested
+# uses in this process share the flock, readers don't need it.
+@contextlib.contextmanager
+def locked_memo_file():
+    with memo_lock:
+        if memo_file_lock['depth'] == 0:
+            lock = open(os.path.expanduser(config['memo-file']) + '.lock', 'a')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            memo_file_lock['file'] = lock
+        memo_file_lock['depth'] += 1
+        try:
+            yield
+        finally:
+            memo_file_lock['depth'] -= 1
+            if memo_file_lock['depth'] == 0:
+                memo_file_lock['file'].close()
+                memo_file_lock['file'] = None
+
+
+# return memos keyed by 16 char txid prefix
 def load_memos():
+    with memo_lock:
+        return dict(refresh_memo_index())
+
+
+# read new log records into the index and return it
+def refresh_memo_index():
+
     fname = os.path.expanduser(config['memo-file'])
     if not os.path.isfile(fname):
         logger.warning('creating new memo file {}'.format(fname))
-        save_memos({})
+        open(fname, 'a').close()
+
+    # start over when the file is new to us, was replaced by another
+    # process compacting it or shrank, the old format is only looked for
+    # then
+    st = os.stat(fname)
+    if memo_index['path'] != fname or memo_index['inode'] != (st.st_dev, st.st_ino) or st.st_size < memo_index['offset']:
+        with locked_memo_file():
+            import_legacy_memos(fname)
+        st = os.stat(fname)
+        memo_index.update({ 'path' : fname, 'inode' : (st.st_dev, st.st_ino), 'offset' : 0, 'records' : 0, 'memos' : {} })
+    size = st.st_size
+
+    if size > memo_index['offset']:
+        try:
+            with open(fname, 'r') as mfile:
+                mfile.seek(memo_index['offset'])
+                for line in mfile:
+
+                    # ignore a partial last line left by a crash
+                    if not line.endswith('\n'):
+                        break
+
+                    memo_index['offset'] += len(line)
+                    if line.strip():
+                        rec = json.loads(line)
+                        memo_index['memos'][rec['txid'][:16]] = rec['memo']
+                        memo_index['records'] += 1
+        except:
+            logger.critical('Unable to parse memo file {}'.format(fname))
+            exit(1)
+
+        n = len(memo_index['memos'])
+        logger.debug('loaded {} memo{} from {}'.format(n, pluralize(n), fname))
+
+    return memo_index['memos']
+
+
+# append a memo for a transaction
+def add_memo(txid, memo):
+    add_memos({ txid : memo })
+
+
+# append memos for many transactions in one write
+def add_memos(memos):
+
+    if len(memos) == 0:
+        return
+
+    with locked_memo_file():
+        refresh_memo_index()
+        append_memo_records([ { 'txid' : txid, 'memo' : memos[txid] } for txid in sorted(memos.keys()) ])
+        if needs_compaction():
+            compact_memos()
+
+
+# memo for a ledger record from the first matching memo-rules entry or
+# None. A rule matches on a counterparty address, or on a substring of
+# the wallet name of the address or any counterparty.
+def match_memo_rule(rules, rec, address):
+
+    index = get_wallet_index()
+    names = []
+    for addr in [address] + rec.get('counterparties', []):
+        pos = index['by_address'].get(addr.lower())
+        if pos is not None:
+            names.append(index['wallet'][pos]['name'].lower())
 
+    for rule in rules:
+        if 'address' in rule and rule['address'] in rec.get('counterparties', []):
+            return rule['memo']
+        if 'name' in rule and any(rule['name'].lower() in name for name in names):
+            return rule['memo']
+
+    return None
+
+
+# tag untagged ledger transactions of every wallet address using the
+# memo-rules config and write the new memos in one batch, returns them
+def auto_tag_memos(rules=None):
+
+    if rules is None:
+        rules = config.get('memo-rules') or []
+
+    memos = load_memos()
+    tagged = {}
+    for item in get_wallet():
+        address = item['address']
+        if config['networking-enabled'] and not sync_ledger(address):
+            logger.error('Unable to sync transactions for {}'.format(address))
+            continue
+
+        with ledger_lock, open_ledger() as db:
+            records = ledger_records(db, address)
+
+        for txid, rec in records.items():
+            if txid[:16] in memos or txid[:16] in tagged:
+                continue
+            memo = match_memo_rule(rules, rec, address)
+            if memo is not None:
+                tagged[txid[:16]] = memo
+
+    add_memos(tagged)
+    logger.info('tagged {} transaction{}'.format(len(tagged), pluralize(len(tagged))))
+    return tagged
+
+
+# append records to the memo log and flush them to disk
+def append_memo_records(records):
+
+    fname = memo_index['path']
     try:
-        with open(fname, 'r') as mfile:
-            memos = json.load(mfile)
-            clipped = {}
-            for k in memos.keys():
-                clipped[k[:16]] = memos[k]
-            logger.debug('loaded {} memo{} from {}'.format(len(memos), pluralize(len(memos)), fname))
-            return clipped
+        with open(fname, 'a') as mfile:
+            for rec in records:
+                mfile.write(json.dumps(rec) + '\n')
+            mfile.flush()
+            os.fsync(mfile.fileno())
     except:
-        logger.critical('Unable to parse memo file {}'.format(fname))
+        logger.critical('Unable to append to memo file {}'.format(fname))
         exit(1)
 
+    n = len(records)
+    logger.debug('appended {} memo{} to {}'.format(n, pluralize(n), fname))
+
+
+# compact once most log records are superseded
+def needs_compaction():
+    return memo_index['records'] > max(config.get('memo-compact-min', 1000), 2 * len(memo_index['memos']))
+
+
+# rewrite the log with one record per memo
+def compact_memos():
+    with locked_memo_file():
+        refresh_memo_index()
+        logger.debug('compacting memo file {}'.format(memo_index['path']))
+        save_memos(memo_index['memos'])
 
+
+# atomically replace all memos
 def save_memos(memos):
     fname = os.path.expanduser(config['memo-file'])
+    tmp = '{}.{}'.format(fname, os.getpid())
     try:
-        with open(fname, 'w') as mfile:
-            mfile.write(json.dumps(memos, indent=4))
-            logger.debug('saved {} memo{} to {}'.format(len(memos), pluralize(len(memos)), fname))
+        with open(tmp, 'w') as mfile:
+            for txid in sorted(memos.keys()):
+                mfile.write(json.dumps({ 'txid' : txid, 'memo' : memos[txid] }) + '\n')
+            mfile.flush()
+            os.fsync(mfile.fileno())
+        os.rename(tmp, fname)
+        logger.debug('saved {} memo{} to {}'.format(len(memos), pluralize(len(memos)), fname))
 
     except:
         logger.critical('Unable to save memo file {} DUMP {}'.format(fname, memos))
         exit(1)
 
+    # the index is rebuilt from the new file on next use
+    memo_index['path'] = None
+
+
+# convert a memo file in the old single JSON dictionary format, the
+# original is kept with a .json suffix
+def import_legacy_memos(fname):
+
+    with open(fname, 'r') as mfile:
+        head = mfile.readline()
+        if not head.startswith('{'):
+            return
+
+        # every line of the log is a complete txid and memo record
+        try:
+            if sorted(json.loads(head).keys()) == ['memo', 'txid']:
+                return
+        except ValueError:
+            pass
+
+        mfile.seek(0)
+        try:
+            memos = json.load(mfile)
+        except ValueError:
+            return
+
+    logger.warning('importing {} memo{} from old format {}'.format(len(memos), pluralize(len(memos)), fname))
+    backup = fname + '.json'
+    shutil.copyfile(fname, backup)
+    save_memos(dict((k[:16], v) for (k, v) in memos.items()))
+
+
+# fee curve of block target -> satoshis per byte, fetched at most once
+# per fee-curve-ttl seconds and shared between commands via the cache
+fee_url = 'https://www.bitgo.com/api/v1/tx/fee'
+fee_curve = { 'curve' : None, 'time' : 0 }
+fee_lock = threading.Lock()
+
+
+# parse a feeByBlockTarget response in satoshis per kB
+def parse_fee_curve(body):
+    try:
+        targets = json.loads(body)['feeByBlockTarget']
+        curve = dict((int(target), fee / 1000.0) for (target, fee) in targets.items())
+    except Exception as e:
+        logger.error('Couldn\'t parse fee curve {}: {} {}'.format(body, type(e).__name__, e))
+        return None
+    return curve if curve else None
+
+
+# Return the fee curve or None. A fresh curve is reused, otherwise it's
+# refetched with a short timeout and the last known curve is used if
+# the endpoint is slow or down.
+def get_fee_curve():
+
+    ttl = config.get('fee-curve-ttl', 300)
+    with fee_lock:
+        now = time.time()
+        if fee_curve['curve'] is not None and now - fee_curve['time'] < ttl:
+            return fee_curve['curve']
+
+        try:
+            entry = cache_get(fee_url)
+        except Exception as e:
+            logger.error('Unable to read cache entry: {}'.format(e))
+            entry = None
+
+        if entry is not None and entry['status'] == 200:
+            curve = parse_fee_curve(entry['body'])
+            if curve is not None and fee_curve['time'] < entry['time']:
+                fee_curve.update({ 'curve' : curve, 'time' : entry['time'] })
+            if curve is not None and (now - entry['time'] < ttl or not config['networking-enabled']):
+                logger.debug('Using fee curve cached {:.0f}s ago'.format(now - entry['time']))
+                return curve
+
+        if not config['networking-enabled']:
+            logger.error('Fee curve unavailable: networking disabled and no cached curve')
+            return None
+
+        # don't wait long when there's a curve to fall back on
+        retries = 0 if fee_curve['curve'] is not None else config.get('max-retries', 5)
+        timeout = (config.get('http-connect-timeout', 5), config.get('fee-timeout', 5))
+        response = http_request('GET', fee_url, retries=retries, timeout=timeout)
+
+        curve = None
+        if response is not None and response_status(response) == 200:
+            body = response.text.strip()
+            curve = parse_fee_curve(body)
+            if curve is not None:
+                fee_curve.update({ 'curve' : curve, 'time' : now })
+                try:
+                    cache_put(fee_url, body, 200)
+                except Exception as e:
+                    logger.error('Unable to write cache entry: {}'.format(e))
+
+        if curve is None and fee_curve['curve'] is not None:
+            logger.warning('Fee endpoint unavailable, using fee curve from {:.0f}s ago'.format(now - fee_curve['time']))
+            return fee_curve['curve']
+
+        return curve
+
+
+# fee for a block target, interpolated linearly between the targets
+# of the curve and clamped to its ends
+def interpolate_fee(curve, target):
+
+    targets = sorted(curve.keys())
+    if target <= targets[0]:
+        return curve[targets[0]]
+    if target >= targets[-1]:
+        return curve[targets[-1]]
+
+    for lo, hi in zip(targets, targets[1:]):
+        if lo <= target <= hi:
+            return curve[lo] + (curve[hi] - curve[lo]) * float(target - lo) / (hi - lo)
+
 
-# returns latest fast confirmation fee as satoshi/byte
+# returns fee for confirmation within blockTarget blocks as satoshi/byte or None
+@daemon_method
 def bitcoin_fee(blockTarget=2):
 
-    # 21.co
-#    url =  'https://bitcoinfees.21.co/api/v1/fees/recommended'
-#    response = url_get(url)
-#    fees = json.loads(response)
-#    return float(fees['fastestFee'])
+    curve = get_fee_curve()
+    if curve is None:
+        return None
+    return interpolate_fee(curve, int(blockTarget))
+
+
+# Payouts waiting to be sent live in an append-only log, one JSON
+# record per line: 'add' queues a payout, 'cancel' withdraws one,
+# 'sending' is written with the txid before a batch is broadcast and
+# 'sent' or 'rejected' after, 'failed' releases a batch back to pending.
+# A batch left 'sending' by a crash or an unanswered broadcast may have
+# reached the network, so it's never sent again until released. A
+# rejected batch isn't retried, it would only be refused again.
+payout_queue_lock = threading.RLock()
+
+
+def get_payout_queue_path():
+    return os.path.expanduser(config.get('payout-queue-file', '~/.basic-wallet-payouts'))
+
+
+# Hold the queue against other processes changing payout states. Flushes,
+# cancels and releases take it, adding payouts doesn't need it.
+@contextlib.contextmanager
+def locked_payout_queue():
+    with payout_queue_lock:
+        with open(get_payout_queue_path() + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+
+# return the queued payouts in the order they were added, each with
+# its 'state': pending, sending, sent, rejected or cancelled
+def load_payout_queue():
+
+    fname = get_payout_queue_path()
+    payouts = {}
+    order = []
+    with payout_queue_lock:
+        if not os.path.isfile(fname):
+            return []
+        try:
+            with open(fname, 'r') as qfile:
+                for line in qfile:
+
+                    # ignore a partial last line left by a crash
+                    if not line.endswith('\n'):
+                        break
+                    if not line.strip():
+                        continue
+
+                    rec = json.loads(line)
+                    if rec['op'] == 'add':
+                        payouts[rec['id']] = { 'id' : rec['id'], 'address' : rec['address'], 'value' : rec['value'],
+                                               'time' : rec['time'], 'state' : 'pending', 'txid' : None }
+                        order.append(rec['id'])
+                    elif rec['op'] == 'cancel':
+                        payouts[rec['id']]['state'] = 'cancelled'
+                    else:
+                        state = { 'sending' : 'sending', 'sent' : 'sent', 'rejected' : 'rejected', 'failed' : 'pending' }[rec['op']]
+                        for id in rec['ids']:
+                            payouts[id]['state'] = state
+                            payouts[id]['txid'] = rec['txid'] if state != 'pending' else None
+        except:
+            logger.critical('Unable to parse payout queue {}'.format(fname))
+            exit(1)
+
+    return [payouts[id] for id in order]
+
+
+def append_payout_records(records):
+
+    fname = get_payout_queue_path()
+    try:
+        with open(fname, 'a') as qfile:
+            os.chmod(fname, 0o600)
+            for rec in records:
+                qfile.write(json.dumps(rec) + '\n')
+            qfile.flush()
+            os.fsync(qfile.fileno())
+    except:
+        logger.critical('Unable to append to payout queue {}'.format(fname))
+        exit(1)
+
+    n = len(records)
+    logger.debug('appended {} payout record{} to {}'.format(n, pluralize(n), fname))
+
+
+# queue payouts of 'address' and 'value' satoshis, returns their ids
+def enqueue_payouts(payouts):
+
+    now = int(time.time())
+    records = []
+    for payout in payouts:
+        id = binascii.hexlify(os.urandom(8))
+        records.append({ 'op' : 'add', 'id' : id, 'address' : payout['address'], 'value' : payout['value'], 'time' : now })
+
+    with payout_queue_lock:
+        append_payout_records(records)
+    return [rec['id'] for rec in records]
+
+
+# cancel pending payouts by id, returns the ids cancelled
+def cancel_payouts(ids):
+
+    with locked_payout_queue():
+        pending = set([payout['id'] for payout in load_payout_queue() if payout['state'] == 'pending'])
+        cancelled = [id for id in ids if id in pending]
+        for id in ids:
+            if id not in pending:
+                logger.warning('Payout {} is not pending, not cancelled'.format(id))
+        if cancelled:
+            append_payout_records([ { 'op' : 'cancel', 'id' : id } for id in cancelled ])
+    return cancelled
+
+
+# record a batch of payouts as 'sending', 'sent', 'rejected' or 'failed'
+# with txid
+def mark_payouts(op, ids, txid):
+    with payout_queue_lock:
+        append_payout_records([ { 'op' : op, 'ids' : ids, 'txid' : txid } ])
+
 
-    # bitgo
-    url = 'https://www.bitgo.com/api/v1/tx/fee?numBlocks={}'.format(blockTarget)
-    response = url_get(url)
-    fees = json.loads(response)
-    targets = fees['feeByBlockTarget']
-    fee = targets[str(blockTarget)]
-    return fee/1000.0
+# return the payouts of a transaction that never reached the network to
+# pending, returns their ids
+def release_payouts(txid):
 
+    with locked_payout_queue():
+        ids = [payout['id'] for payout in load_payout_queue() if payout['state'] == 'sending' and payout['txid'] == txid]
+        if ids:
+            mark_payouts('failed', ids, txid)
+    return ids
@@ -0,0 +1,250 @@
+
+# Coin selection: choose which UTXOs fund a payment.
+#
+# Every algorithm works on effective values, the UTXO value minus the
+# fee to spend it, so adding an input never makes a payment cheaper
+# than it looks. select_coins() runs branch and bound first, which
+# searches for an input set that needs no change output, and falls
+# back to a knapsack solver that creates change. Both searches are
+# bounded by a budget of tries so huge wallets stay fast.
+#
+# UTXOs are dicts with at least a 'value' in satoshis and optionally
+# the 'size' of the input spending them, SegWit inputs are smaller.
+# Sizes are bytes:
+#   sizes = { 'base' : 10, 'input' : 180, 'output' : 34 }
+
+import random
+
+
+default_budget = 100000
+
+
+# fee in satoshis for a tx with n inputs and m outputs
+def tx_fee(sizes, fee_per_byte, inputs, outputs):
+    return (sizes['base'] + sizes['input'] * inputs + sizes['output'] * outputs) * fee_per_byte
+
+
+def input_size(utxo, sizes):
+    return utxo.get('size', sizes['input'])
+
+
+def effective_value(utxo, sizes, fee_per_byte):
+    return utxo['value'] - input_size(utxo, sizes) * fee_per_byte
+
+
+# Branch and bound search for a changeless input set, after Bitcoin
+# Core. pool is a list of (effective value, utxo) sorted descending.
+# Looks for a sum in [target, target + cost_of_change] with the least
+# waste, returns the list of utxos or None. Waste is the excess plus
+# input_waste for every input, the extra cost of spending an input now
+# rather than at the long term fee rate.
+def select_bnb(pool, target, cost_of_change, budget=default_budget, input_waste=0):
+
+    values = [eff for (eff, utxo) in pool]
+    available = sum(values)
+    if available < target:
+        return None
+
+    best = None
+    best_waste = None
+    selected = []
+    depth = 0
+    value = 0
+
+    for tries in range(budget):
+
+        backtrack = False
+        if value + available < target or value > target + cost_of_change:
+            backtrack = True
+        elif input_waste > 0 and best is not None and len(selected) * input_waste > best_waste:
+            backtrack = True
+        elif value >= target:
+            waste = value - target + len(selected) * input_waste
+            if best is None or waste < best_waste or (waste == best_waste and len(selected) < len(best)):
+                best = list(selected)
+                best_waste = waste
+                if waste == 0 and input_waste >= 0:
+                    break
+            backtrack = True
+        elif depth == len(values):
+            backtrack = True
+
+        if backtrack:
+            if len(selected) == 0:
+                break
+
+            # undecide the excluded tail, then exclude the last included
+            last = selected.pop()
+            for i in range(last + 1, depth):
+                available += values[i]
+            value -= values[last]
+            depth = last + 1
+
+        # equal to an excluded sibling, so including it was already tried
+        elif depth > 0 and values[depth] == values[depth - 1] and (len(selected) == 0 or selected[-1] != depth - 1):
+            available -= values[depth]
+            depth += 1
+
+        else:
+            available -= values[depth]
+            value += values[depth]
+            selected.append(depth)
+            depth += 1
+
+    if best is None:
+        return None
+    return [pool[i][1] for i in best]
+
+
+# Stochastic approximation of the smallest subset summing to at least
+# target, after Bitcoin Core. Returns (included flags, sum).
+def approximate_best_subset(values, total, target, iterations, rng):
+
+    best = [True] * len(values)
+    best_sum = total
+
+    for rep in range(iterations):
+        if best_sum == target:
+            break
+
+        included = [False] * len(values)
+        subtotal = 0
+        reached = False
+        for npass in range(2):
+            if reached:
+                break
+            for i in range(len(values)):
+                if (rng.random() < 0.5) if npass == 0 else (not included[i]):
+                    subtotal += values[i]
+                    included[i] = True
+                    if subtotal >= target:
+                        reached = True
+                        if subtotal < best_sum:
+                            best_sum = subtotal
+                            best = list(included)
+                        subtotal -= values[i]
+                        included[i] = False
+
+    return best, best_sum
+
+
+# Knapsack solver for a payment with change. pool is a list of
+# (effective value, utxo). Returns the list of utxos or None.
+def select_knapsack(pool, target, min_change, budget=default_budget, rng=None):
+
+    rng = rng or random.Random()
+    shuffled = list(pool)
+    rng.shuffle(shuffled)
+
+    lower = []
+    lowest_larger = None
+    for eff, utxo in shuffled:
+        if eff == target:
+            return [utxo]
+        elif eff < target + min_change:
+            lower.append((eff, utxo))
+        elif lowest_larger is None or eff < lowest_larger[0]:
+            lowest_larger = (eff, utxo)
+
+    total_lower = sum([eff for (eff, utxo) in lower])
+    if total_lower == target:
+        return [utxo for (eff, utxo) in lower]
+
+    if total_lower < target:
+        return None if lowest_larger is None else [lowest_larger[1]]
+
+    # every pass touches each candidate, so the budget buys fewer passes
+    lower.sort(key=lambda k: k[0], reverse=True)
+    values = [eff for (eff, utxo) in lower]
+    iterations = max(1, min(1000, budget // max(1, len(values))))
+
+    best, best_sum = approximate_best_subset(values, total_lower, target, iterations, rng)
+    if best_sum != target and total_lower >= target + min_change:
+        best, best_sum = approximate_best_subset(values, total_lower, target + min_change, iterations, rng)
+
+    if lowest_larger is not None and \
+       ((best_sum != target and best_sum < target + min_change) or lowest_larger[0] <= best_sum):
+        return [lowest_larger[1]]
+
+    return [lower[i][1] for i in range(len(lower)) if best[i]]
+
+
+# Greedy selection in value order, the original sendbtc behaviour.
+# Stops once the inputs cover the payment with change, or exactly
+# enough without it.
+def select_greedy(pool, target, target_with_change, cost_of_change, largest_first=True):
+
+    ordered = sorted(pool, key=lambda k: k[0], reverse=largest_first)
+    chosen = []
+    total = 0
+    for eff, utxo in ordered:
+        chosen.append(utxo)
+        total += eff
+        if target <= total <= target + cost_of_change or total >= target_with_change:
+            return chosen
+
+    return None
+
+
+# auto is branch and bound with a knapsack fallback
+algorithms = ( 'auto', 'knapsack', 'largest-first', 'smallest-first' )
+
+
+# Select inputs paying amount satoshis. Returns a dict with the
+# 'inputs', the 'change' amount (0 for none), the total 'fee' and the
+# 'excess' given to the miner beyond the size based fee when change
+# wasn't worth creating, plus the 'algorithm' that found it. Returns
+# None if the UTXOs can't cover the payment. When fees are above the
+# long_term_fee rate branch and bound prefers fewer inputs. The amount
+# may be split across several outputs, change is one more. Change
+# below min_change, the dust limit of the change output, goes to the
+# miner.
+def select_coins(utxos, amount, fee_per_byte, sizes, algorithm='auto', budget=default_budget, rng=None, long_term_fee=None, outputs=1, min_change=0):
+
+    if algorithm not in algorithms:
+        raise ValueError('Unknown coin selection algorithm {}'.format(algorithm))
+
+    # inputs that cost more to spend than they're worth are skipped
+    pool = [(effective_value(utxo, sizes, fee_per_byte), utxo) for utxo in utxos]
+    pool = [(eff, utxo) for (eff, utxo) in pool if eff > 0]
+    pool.sort(key=lambda k: k[0], reverse=True)
+
+    # change costs an output now and an input when it's spent later
+    target = amount + tx_fee(sizes, fee_per_byte, 0, outputs)
+    target_with_change = amount + tx_fee(sizes, fee_per_byte, 0, outputs + 1)
+    cost_of_change = (sizes['output'] + sizes['input']) * fee_per_byte
+    change_threshold = max(cost_of_change, min_change)
+
+    if long_term_fee is None:
+        long_term_fee = fee_per_byte
+    input_waste = sizes['input'] * (fee_per_byte - long_term_fee)
+
+    chosen = None
+    used = algorithm
+    if algorithm == 'auto':
+        chosen = select_bnb(pool, target, cost_of_change, budget, input_waste)
+        used = 'bnb'
+    if chosen is None and algorithm in ('auto', 'knapsack'):
+        chosen = select_knapsack(pool, target_with_change, change_threshold, budget, rng)
+        used = 'knapsack'
+    if algorithm in ('largest-first', 'smallest-first'):
+        chosen = select_greedy(pool, target, target_with_change, cost_of_change, algorithm == 'largest-first')
+
+    if chosen is None:
+        return None
+
+    total = sum([utxo['value'] for utxo in chosen])
+    spend = sum([input_size(utxo, sizes) for utxo in chosen]) * fee_per_byte
+    fee = tx_fee(sizes, fee_per_byte, 0, outputs) + spend
+    change = total - amount - tx_fee(sizes, fee_per_byte, 0, outputs + 1) - spend
+
+    if change >= change_threshold:
+        fee = tx_fee(sizes, fee_per_byte, 0, outputs + 1) + spend
+    else:
+        change = 0
+
+    excess = total - amount - change - fee
+    if excess < 0:
+        return None
+
+    return { 'inputs' : chosen, 'change' : change, 'fee' : fee + excess, 'excess' : excess, 'algorithm' : used }
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+# Merge small UTXOs into fewer outputs while fees are low. Every later
+# transaction then spends fewer inputs, which makes it smaller, cheaper
+# and faster to sign.
+
+import argparse, logging, time
+from btclib import config, logger, lookup, get_wallet, get_bitcoin_price, bitcoin_fee, broadcast, pluralize
+from txsign import output_script
+from txsize import input_vsize, tx_vsize, dust_limit
+from sendbtc import gather_utxos, check_fee, sign_payment, default_max_tx_vsize
+
+
+# UTXOs worth merging: no bigger than max_value satoshis and worth more
+# than it costs to spend them at fee_per_byte
+def consolidation_candidates(utxos, fee_per_byte, max_value):
+    return [utxo for utxo in utxos if utxo['value'] <= max_value and utxo['value'] > input_vsize(utxo['kind']) * fee_per_byte]
+
+
+# Plan transactions merging UTXOs, smallest first, into one output to
+# dest, or back to their own address when dest is None. Each spends at
+# least min_inputs, is at most max_vsize vbytes and pays an output
+# above the dust limit. Returns a list of payments with the 'inputs',
+# 'outputs' and estimated 'vsize'.
+def plan_consolidation(utxos, fee_per_byte, dest=None, min_inputs=2, max_vsize=default_max_tx_vsize):
+
+    groups = {}
+    for utxo in sorted(utxos, key=lambda k: k['value']):
+        groups.setdefault(dest or utxo['address'], []).append(utxo)
+
+    payments = []
+    for address in sorted(groups.keys()):
+        scripts = [ output_script(address) ]
+        chunks = [[]]
+        for utxo in groups[address]:
+            if tx_vsize([x['kind'] for x in chunks[-1] + [utxo]], scripts) > max_vsize:
+                chunks.append([])
+            chunks[-1].append(utxo)
+
+        for txins in chunks:
+            if len(txins) < min_inputs:
+                logger.debug('Only {} UTXO{} to merge into {}, skipping'.format(len(txins), pluralize(len(txins)), address))
+                continue
+            est_vsize = tx_vsize([utxo['kind'] for utxo in txins], scripts)
+            value = sum([utxo['value'] for utxo in txins]) - est_vsize * fee_per_byte
+
+            # every input adds more than it costs, so fewer can't help
+            if value < dust_limit(scripts[0]):
+                logger.debug('Merging {} UTXOs into {} leaves {:,.0f} Satoshi, below the dust limit, skipping'.format(len(txins), address, value))
+                continue
+            payments.append({ 'inputs' : txins, 'outputs' : [ { 'address' : address, 'value' : value } ], 'vsize' : est_vsize })
+
+    return payments
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Merge small UTXOs into fewer outputs when fees are low')
+    parser.add_argument('-f', '--from', help='addresses to consolidate, defaults to all active wallet addresses', nargs='+', required=False)
+    parser.add_argument('-t', '--to', help='merge everything into one output to this address instead of one per address', nargs=1, required=False)
+    parser.add_argument('-w', '--wait', help='wait until the fee drops below consolidate-max-fee', action='store_true', required=False)
+    parser.add_argument('-n', '--dry-run', help='only show what would be merged', action='store_true', required=False)
+    parser.add_argument('-y', '--yes', help='don\'t ask for confirmation', action='store_true', required=False)
+    parser.add_argument('-o', '--override', help='override high fee sanity check', action='store_true', required=False)
+    parser.add_argument('-v', '--verbose', help='show verbose output', action='store_true', required=False)
+    args = vars(parser.parse_args())
+
+    if (args['verbose']):
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    # active addresses we hold keys for
+    if args['from']:
+        entries = []
+        for source in args['from']:
+            entry = lookup(source)
+            if (entry == None):
+                logger.error('No source address found in wallet matching "{}"'.format(source))
+                exit(1)
+            entries.append(entry)
+    else:
+        entries = [item for item in get_wallet() if item['privkey'] is not None and item['active']]
+    if len(entries) == 0:
+        logger.error('No wallet addresses to consolidate')
+        exit(1)
+
+    dest = None
+    if args['to']:
+        item = lookup(args['to'][0])
+        dest = item['address'] if item is not None else args['to'][0]
+
+    # wait for a low fee; blocks far out are what a merge can wait for
+    max_fee = config.get('consolidate-max-fee', 5)
+    target = config.get('consolidate-block-target', 144)
+    while True:
+        fee_per_byte = bitcoin_fee(target)
+        if fee_per_byte is None:
+            logger.error('Unable to fetch the current fee')
+            exit(1)
+        fee_per_byte = int(round(fee_per_byte))
+        if fee_per_byte <= max_fee:
+            break
+        logger.info('Fee of {} satoshis per byte is above consolidate-max-fee {}'.format(fee_per_byte, max_fee))
+        if not args['wait'] or args['dry_run']:
+            exit(0)
+        time.sleep(config.get('consolidate-poll-interval', 600))
+    fee_per_byte = max(fee_per_byte, 1)
+    logger.debug('Using fee of {} satoshis per byte'.format(fee_per_byte))
+
+    # inventory
+    gathered = gather_utxos(entries)
+    if gathered is None:
+        exit(1)
+    utxos, privkeys = gathered
+    max_value = config.get('consolidate-max-value', 1000000)
+    candidates = consolidation_candidates(utxos, fee_per_byte, max_value)
+    for entry in entries:
+        held = [utxo for utxo in utxos if utxo['address'] == entry['address']]
+        small = [utxo for utxo in candidates if utxo['address'] == entry['address']]
+        logger.info('Address {} has {} UTXO{}, {} to merge worth {:,.0f} Satoshi'.format(entry['address'], len(held), pluralize(len(held)),
+                                                                                     len(small), sum([utxo['value'] for utxo in small])))
+
+    max_vsize = config.get('max-tx-vsize', default_max_tx_vsize)
+    payments = plan_consolidation(candidates, fee_per_byte, dest, config.get('consolidate-min-utxos', 10), max_vsize)
+    if len(payments) == 0:
+        logger.info('Nothing to consolidate')
+        exit(0)
+
+    # all but one input of each merge is one later transactions won't pay for
+    btc_price = get_bitcoin_price()
+    merged = sum([len(payment['inputs']) for payment in payments])
+    long_term_fee = config.get('long-term-fee', 10)
+    saved = sum([utxo['size'] * long_term_fee for payment in payments for utxo in payment['inputs'][1:]])
+    logger.warning('Merging {:,} UTXOs into {} output{}, saving about {:,.0f} Satoshi at {} satoshis per byte later'.format(
+        merged, len(payments), pluralize(len(payments)), saved, long_term_fee))
+    if args['dry_run']:
+        exit(0)
+
+    txs = []
+    fee_satoshi = 0
+    for payment in payments:
+        fee = check_fee(payment['inputs'], payment['outputs'], btc_price, args['override'])
+        if fee is None:
+            exit(1)
+        tx = sign_payment(payment['inputs'], payment['outputs'], privkeys, payment['vsize'])
+        if tx is None:
+            exit(1)
+        fee_satoshi += fee
+        txs.append(tx)
+
+    fee_btc = fee_satoshi/1e8
+    logger.warning('Consolidating in {} transaction{} using fee of {:,.8f} BTC ${:,.2f} USD'.format(len(txs), pluralize(len(txs)), fee_btc, fee_btc * btc_price))
+    if not args['yes']:
+        raw_input('[ Press Enter to confirm ]')
+
+    failures = 0
+    for tx in txs:
+        tid = broadcast(tx)
+        if tid is None:
+            logger.critical('Failed to submit transaction to the network')
+            failures += 1
+        else:
+            logger.warning('Broadcasted TXID {}'.format(tid))
+
+    if failures:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
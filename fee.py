@@ -2,7 +2,7 @@
 
 
 import argparse, logging
-from btclib import logger, bitcoin_fee
+from btclib import logger, bitcoin_fee, get_fee_curve
 
 
 default_block_target = 2
@@ -24,6 +24,7 @@ def valid_target(arg):
 parser = argparse.ArgumentParser(description='Fetch the latest fast confirmation bitcoin fee')
 parser.add_argument('-v', '--verbose', help='show verbose output', action='store_true', required=False)
 parser.add_argument('-b', '--blocktarget', help='want confirmation in this many blocks', type=valid_target, required=False, default=default_block_target)
+parser.add_argument('-a', '--all', help='show the fee for every block target', action='store_true', required=False)
 args = vars(parser.parse_args())
 
 
@@ -32,6 +33,18 @@ if (args['verbose']):
 else:
     logger.setLevel(logging.INFO)
 
+# the whole curve comes from a single request
+if args['all']:
+    curve = get_fee_curve()
+    if curve is None:
+        exit(1)
+    for blocks in sorted(curve.keys()):
+        logger.info('fee for confirmation in {} blocks: {} sat/byte'.format(blocks, curve[blocks]))
+    exit(0)
+
 blocks = args['blocktarget']
 logger.debug('block target: {}'.format(blocks))
-logger.info('fee for confirmation in {} blocks: {} sat/byte'.format(blocks, bitcoin_fee(blocks)))
+fee = bitcoin_fee(blocks)
+if fee is None:
+    exit(1)
+logger.info('fee for confirmation in {} blocks: {} sat/byte'.format(blocks, fee))
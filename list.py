@@ -2,8 +2,8 @@
 
 # List transactions for one or more addresses
 
-import argparse, logging
-from btclib import logger, get_transactions, lookup, get_wallet
+import argparse, logging, time
+from btclib import logger, get_transactions, lookup, get_wallet, price_at
 
 
 def main():
@@ -11,6 +11,7 @@ def main():
     # parse arguments
     parser = argparse.ArgumentParser(description='List transactions for one or more addresses')
     parser.add_argument('-f', '--from', help='fetch transactions from these addresses',  nargs='+', required=False)
+    parser.add_argument('-u', '--usd', help='show USD values at the time of each transaction', action='store_true', required=False)
     parser.add_argument('-v', '--verbose', help='show verbose output', action='store_true', required=False)
     args = vars(parser.parse_args())
 
@@ -29,7 +30,11 @@ def main():
 
     txs = []
     for name in addrs:
-        txs.extend(get_transactions(lookup(name)['address']))
+        found = get_transactions(lookup(name)['address'])
+        if found is None:
+            logger.critical('unable to fetch transactions')
+            exit(1)
+        txs.extend(found)
 
     if len(txs) == 0:
         logger.info('No transactions found')
@@ -45,6 +50,11 @@ def main():
         balance += rec['amount']
         id = rec['id'] if args['verbose'] else rec['id'][:16]
         line = '%s %s %4s %+13.8f %+13.8f' % (rec['date'], id, rec['memo'], rec['amount'], balance)
+
+        # valued from the local price history, dates are local time
+        if args['usd']:
+            price = price_at(time.mktime(time.strptime(rec['date'], '%Y-%m-%d %H:%M:%S')))
+            line += ' %12s' % ('-' if price is None else '{:+,.2f}'.format(rec['amount'] * price))
         report.append(line)
 
     n = len(report)
@@ -1,17 +1,62 @@
 #!/usr/bin/env python
 
-# Fetches balance for a single address or entire wallet
+# Add, import, export and auto-tag transaction memos
 
-import argparse, logging
-from btclib import logger, load_memos, save_memos
+import sys, argparse, logging, csv, json
+from btclib import logger, add_memo, add_memos, load_memos, compact_memos, auto_tag_memos
+
+
+# read txid to memo mappings from a CSV (txid,memo) or JSONL file
+def read_memo_file(fname):
+
+    memos = {}
+    with open(fname, 'r') as mfile:
+
+        if fname.lower().endswith('.csv'):
+            for row in csv.reader(mfile):
+                if len(row) == 0 or row[0].strip().lower() == 'txid':
+                    continue
+                if len(row) < 2:
+                    raise ValueError('expected txid,memo but got {}'.format(row))
+                memos[row[0].strip()] = row[1].decode('utf-8')
+
+        else:
+            for line in mfile:
+                if line.strip():
+                    rec = json.loads(line)
+                    memos[rec['txid']] = rec['memo']
+
+    return memos
+
+
+# write memos as CSV or JSONL, to stdout when fname is -
+def write_memo_file(fname, memos):
+
+    mfile = sys.stdout if fname == '-' else open(fname, 'w')
+    try:
+        if fname.lower().endswith('.csv'):
+            writer = csv.writer(mfile)
+            writer.writerow(['txid', 'memo'])
+            for txid in sorted(memos.keys()):
+                writer.writerow([txid, memos[txid].encode('utf-8')])
+        else:
+            for txid in sorted(memos.keys()):
+                mfile.write(json.dumps({ 'txid' : txid, 'memo' : memos[txid] }) + '\n')
+    finally:
+        if mfile is not sys.stdout:
+            mfile.close()
 
 
 def main():
 
     # parse arguments
     parser = argparse.ArgumentParser(description='Add a memo to a transaction')
-    parser.add_argument('-t', '--txid', help='transaction id',  nargs=1, required=True)
-    parser.add_argument('-m', '--memo', help='up to 64 chars of memo text', nargs=1, required=True)
+    parser.add_argument('-t', '--txid', help='transaction id',  nargs=1, required=False)
+    parser.add_argument('-m', '--memo', help='up to 64 chars of memo text', nargs=1, required=False)
+    parser.add_argument('-i', '--import', help='import memos from a .csv (txid,memo) or .jsonl file', nargs=1, required=False)
+    parser.add_argument('-e', '--export', help='export memos to a .csv or .jsonl file, - for JSONL on stdout', nargs=1, required=False)
+    parser.add_argument('-a', '--autotag', help='tag untagged transactions using memo-rules', action='store_true', required=False)
+    parser.add_argument('-c', '--compact', help='compact the memo file', action='store_true', required=False)
     parser.add_argument('-v', '--verbose', help='show verbose output', action='store_true', required=False)
     args = vars(parser.parse_args())
 
@@ -20,11 +65,30 @@ def main():
     else:
         logger.setLevel(logging.INFO)
 
-    txid = args['txid'][0]
-    memo = args['memo'][0]
-    m = load_memos()
-    m[txid] = memo
-    save_memos(m)
+    if (args['txid'] is None) != (args['memo'] is None):
+        parser.error('--txid and --memo must be given together')
+
+    if args['txid'] is not None:
+        add_memo(args['txid'][0], args['memo'][0])
+
+    if args['import'] is not None:
+        fname = args['import'][0]
+        try:
+            memos = read_memo_file(fname)
+        except Exception as e:
+            logger.critical('Unable to read memos from {}: {}'.format(fname, e))
+            exit(1)
+        add_memos(memos)
+        logger.info('imported {} memos from {}'.format(len(memos), fname))
+
+    if args['autotag']:
+        auto_tag_memos()
+
+    if args['compact']:
+        compact_memos()
+
+    if args['export'] is not None:
+        write_memo_file(args['export'][0], load_memos())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+# Queue payouts and send them in batches. Services add payouts as they
+# come in, the flusher pays every pending payout in one transaction once
+# payout-batch-count are waiting or the oldest has waited
+# payout-batch-age seconds.
+
+import argparse, logging, time
+from btclib import config, logger, lookup, get_bitcoin_price, bitcoin_fee, send_tx, pluralize
+from btclib import load_payout_queue, enqueue_payouts, cancel_payouts, mark_payouts, release_payouts, locked_payout_queue
+from validate import validate_addresses
+from txsign import signed_txid
+from sendbtc import valid_fee, read_payout_file, merge_payouts, dust_payouts, gather_utxos, build_payments, check_fee, sign_payment
+from sendbtc import default_max_tx_vsize
+
+
+# True once enough payouts are pending or the oldest is old enough
+def batch_ready(pending, now):
+    if len(pending) == 0:
+        return False
+    if len(pending) >= config.get('payout-batch-count', 50):
+        return True
+    return now - min([payout['time'] for payout in pending]) >= config.get('payout-batch-age', 3600)
+
+
+# Send pending payouts from the wallet entries when a batch is ready, or
+# regardless with force. Returns the number of payouts sent. The queue
+# stays locked until every batch is marked, so payouts can't be
+# cancelled or flushed by another process meanwhile.
+def flush_payouts(entries, fee_per_byte=None, override=False, force=False):
+    with locked_payout_queue():
+        return send_pending(entries, fee_per_byte, override, force)
+
+
+def send_pending(entries, fee_per_byte, override, force):
+
+    queue = load_payout_queue()
+    for payout in queue:
+        if payout['state'] == 'sending':
+            logger.warning('Payout {} may have been sent in TXID {}, check it and release it with -r if not'.format(payout['id'], payout['txid']))
+
+    pending = [payout for payout in queue if payout['state'] == 'pending']
+    if not (force or batch_ready(pending, time.time())):
+        logger.debug('{} payout{} pending, batch not ready'.format(len(pending), pluralize(len(pending))))
+        return 0
+    if len(pending) == 0:
+        logger.info('No pending payouts')
+        return 0
+
+    gathered = gather_utxos(entries)
+    if gathered is None:
+        return 0
+    utxos, privkeys = gathered
+    if len(utxos) == 0:
+        logger.error('No confirmed UTXOs found')
+        return 0
+
+    # the next flush retries when a quote fails
+    btc_price = get_bitcoin_price()
+    if btc_price is None:
+        logger.error('Unable to fetch the Bitcoin price')
+        return 0
+    if fee_per_byte is None:
+        fee_per_byte = bitcoin_fee()
+        if fee_per_byte is None:
+            logger.error('Unable to fetch the current fee')
+            return 0
+    fee_per_byte = int(fee_per_byte)
+    logger.debug('Using fee of {} satoshis per byte'.format(fee_per_byte))
+
+    # repeated addresses share an output
+    ids = {}
+    for payout in pending:
+        ids.setdefault(payout['address'], []).append(payout['id'])
+    outputs = merge_payouts([ { 'address' : payout['address'], 'value' : payout['value'] } for payout in pending ])
+
+    algorithm = config.get('coin-selection', 'auto')
+    max_vsize = config.get('max-tx-vsize', default_max_tx_vsize)
+    payments = build_payments(utxos, outputs, fee_per_byte, algorithm, btc_price, max_vsize)
+    if payments is None:
+        return 0
+
+    # each transaction is checked on its own, one failing leaves its
+    # payouts pending for the next flush
+    sent = 0
+    for payment in payments:
+        batch = [id for payout in payment['payouts'] for id in ids[payout['address']]]
+        if check_fee(payment['inputs'], payment['outputs'], btc_price, override) is None:
+            logger.error('Not sending {} payout{}'.format(len(batch), pluralize(len(batch))))
+            continue
+        tx = sign_payment(payment['inputs'], payment['outputs'], privkeys, payment['vsize'])
+        if tx is None:
+            continue
+
+        # only payouts still pending in the log are committed to
+        states = dict([(payout['id'], payout['state']) for payout in load_payout_queue()])
+        if any([states[id] != 'pending' for id in batch]):
+            logger.error('Payouts changed since the queue was read, leaving {} for the next flush'.format(len(batch)))
+            continue
+
+        # unless the transaction was refused outright it may be on the
+        # network, and sending its payouts again would pay them twice
+        txid = signed_txid(tx)
+        mark_payouts('sending', batch, txid)
+        pushed, rejected = send_tx(tx)
+        if pushed is None:
+            if rejected:
+                logger.critical('Transaction {} was rejected, queue its payouts again once fixed: {}'.format(txid, ' '.join(batch)))
+                mark_payouts('rejected', batch, txid)
+            else:
+                logger.critical('Transaction {} may have reached the network, check it and release it with -r if not'.format(txid))
+            continue
+        mark_payouts('sent', batch, txid)
+        logger.warning('Sent {} payout{} in TXID {}'.format(len(batch), pluralize(len(batch)), txid))
+        sent += len(batch)
+
+    return sent
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Queue payouts and send them in batches')
+    parser.add_argument('-a', '--add', help='queue a payout of AMOUNT BTC to ADDRESS', nargs=2, metavar=('ADDRESS', 'AMOUNT'), required=False)
+    parser.add_argument('-p', '--payouts', help='queue every payout in a CSV (address,amount) or JSONL file', nargs=1, required=False)
+    parser.add_argument('-l', '--list', help='list pending payouts', action='store_true', required=False)
+    parser.add_argument('-A', '--all', help='also list sent and cancelled payouts', action='store_true', required=False)
+    parser.add_argument('-c', '--cancel', help='cancel pending payouts by id', nargs='+', required=False)
+    parser.add_argument('-r', '--release', help='return payouts of a transaction that never reached the network to pending', nargs=1, metavar='TXID', required=False)
+    parser.add_argument('-s', '--send', help='send pending payouts once a batch is ready', action='store_true', required=False)
+    parser.add_argument('-f', '--from', help='one or more addresses to send from', nargs='+', required=False)
+    parser.add_argument('-F', '--force', help='send pending payouts now', action='store_true', required=False)
+    parser.add_argument('-w', '--watch', help='keep sending batches as they become ready', action='store_true', required=False)
+    parser.add_argument('-m', '--fee', help='miner fee in Satoshis per byte, defaults to the current fast confirmation fee', nargs=1, type=valid_fee, required=False)
+    parser.add_argument('-o', '--override', help='override high fee sanity check', action='store_true', required=False)
+    parser.add_argument('-v', '--verbose', help='show verbose output', action='store_true', required=False)
+    args = vars(parser.parse_args())
+
+    if (args['verbose']):
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    # queue new payouts, every address is checked first
+    payouts = []
+    if args['add']:
+        try:
+            value = int(round(float(args['add'][1]) * 1e8))
+        except ValueError:
+            logger.error('Invalid amount "{}"'.format(args['add'][1]))
+            exit(1)
+        if value <= 0:
+            logger.error('Payout amount must be positive')
+            exit(1)
+        payouts.append({ 'address' : args['add'][0], 'value' : value })
+    if args['payouts']:
+        try:
+            payouts += read_payout_file(args['payouts'][0])
+        except (IOError, ValueError, KeyError) as err:
+            logger.error('Unable to read payout file {}: {}'.format(args['payouts'][0], err))
+            exit(1)
+
+    if payouts:
+        valid = validate_addresses([payout['address'] for payout in payouts])
+        invalid = [address for address in valid if not valid[address]]
+        for address in invalid:
+            logger.error('Payout address "{}" is not a valid Bitcoin address'.format(address))
+        if invalid:
+            exit(1)
+        dust = dust_payouts(payouts)
+        for payout in dust:
+            logger.error('Payout of {:,.0f} Satoshi to {} is below the dust limit'.format(payout['value'], payout['address']))
+        if dust:
+            exit(1)
+        for id, payout in zip(enqueue_payouts(payouts), payouts):
+            logger.info('Queued payout {} of {:,.8f} BTC to {}'.format(id, payout['value']/1e8, payout['address']))
+
+    if args['cancel']:
+        for id in cancel_payouts(args['cancel']):
+            logger.info('Cancelled payout {}'.format(id))
+
+    if args['release']:
+        txid = args['release'][0]
+        batch = release_payouts(txid)
+        if len(batch) == 0:
+            logger.error('No payouts are being sent in TXID {}'.format(txid))
+            exit(1)
+        logger.warning('Released {} payout{} of TXID {}'.format(len(batch), pluralize(len(batch)), txid))
+
+    if args['list'] or args['all']:
+        for payout in load_payout_queue():
+            if args['all'] or payout['state'] in ('pending', 'sending', 'rejected'):
+                date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(payout['time']))
+                print '%s %s %-42s %13.8f %-9s %s' % (payout['id'], date, payout['address'], payout['value']/1e8, payout['state'], payout['txid'] or '')
+
+    if not (args['send'] or args['force'] or args['watch']):
+        exit(0)
+
+    # source addresses
+    if not args['from']:
+        logger.error('Specify the addresses to send from with -f')
+        exit(1)
+    entries = []
+    for source in args['from']:
+        entry = lookup(source)
+        if (entry == None):
+            logger.error('No source address found in wallet matching "{}"'.format(source))
+            exit(1)
+        entries.append(entry)
+
+    fee = int(args['fee'][0]) if args['fee'] else None
+    flush_payouts(entries, fee, args['override'], args['force'])
+    while args['watch']:
+        time.sleep(config.get('payout-flush-interval', 60))
+        flush_payouts(entries, fee, args['override'], args['force'])
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,8 @@
 # amount to a BTC amount.
 
 
-import sys, argparse, logging
-from btclib import logger, get_bitcoin_price
+import sys, argparse, logging, time
+from btclib import logger, get_bitcoin_price, add_prices
 
 
 def main():
@@ -15,6 +15,7 @@ def main():
     parser = argparse.ArgumentParser(description='Fetch latest Bitcoin price')
     parser.add_argument('-u', '--USD', help='convert a USD dollar amount to BTC', nargs=1, type=float, required=False)
     parser.add_argument('-b', '--BTC', help='convert a BTC amount to USD', nargs=1, type=float, required=False)
+    parser.add_argument('-i', '--import', help='add past prices to the local history from a CSV file of date (YYYY-MM-DD) and USD price', nargs=1, required=False)
     parser.add_argument('-v', '--verbose', help='show verbose output', action='store_true', required=False)
     args = vars(parser.parse_args())
 
@@ -23,6 +24,20 @@ def main():
     else:
         logger.setLevel(logging.WARNING)
 
+    # seed the history list.py values old transactions with
+    if args['import'] is not None:
+        samples = []
+        with open(args['import'][0]) as pfile:
+            for n, line in enumerate(pfile):
+                try:
+                    date, usd = line.strip().split(',')[:2]
+                    samples.append((time.mktime(time.strptime(date.strip(), '%Y-%m-%d')), float(usd)))
+                except ValueError:
+                    logger.warning('Skipping line {}: {}'.format(n + 1, line.strip()))
+        add_prices(samples)
+        sys.stdout.write('Imported {} price{}\n'.format(len(samples), '' if len(samples) == 1 else 's'))
+        exit(0)
+
 
     price = get_bitcoin_price()
     if price is None:
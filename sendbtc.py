@@ -2,11 +2,18 @@
 
 # Construct a Bitcoin transaction and submit it to the network.
 
-import logging, argparse, json
-from btclib import config, logger, get_unspent, get_bitcoin_price, lookup
+import logging, argparse, json, csv
+from btclib import config, logger, get_unspent_many, get_bitcoin_price, lookup
 from btclib import pluralize, broadcast, bitcoin_fee
-from bitcoin import mktx, sign
-from validate import validate_address
+from bitcoin import mktx
+from txsign import sign_inputs, output_script
+from txsize import input_kind, input_vsize, output_size, tx_vsize, signed_vsize, dust_limit
+from validate import validate_address, validate_addresses
+from coinselect import select_coins, tx_fee, algorithms
+
+
+# largest transaction relayed by default, 400,000 weight units
+default_max_tx_vsize = 100000
 
 
 # validate miner fee argument
@@ -22,19 +29,295 @@ def valid_fee(arg):
     return arg
 
 
-def main():
+# Read payouts from CSV (address,amount) or JSONL ({"address", "amount"})
+# with amounts in BTC. Returns a list of outputs in file order with the
+# values in satoshis.
+def read_payout_file(fname):
+
+    payouts = []
+    with open(fname, 'r') as pfile:
+
+        if fname.lower().endswith('.csv'):
+            for row in csv.reader(pfile):
+                if len(row) == 0 or row[0].strip().lower() == 'address':
+                    continue
+                if len(row) < 2:
+                    raise ValueError('expected address,amount but got {}'.format(row))
+                payouts.append((row[0].strip(), float(row[1])))
+
+        else:
+            for line in pfile:
+                if line.strip():
+                    rec = json.loads(line)
+                    payouts.append((rec['address'], float(rec['amount'])))
+
+    outputs = []
+    for address, amount_btc in payouts:
+        value = int(round(amount_btc * 1e8))
+        if value <= 0:
+            raise ValueError('amount for {} must be positive, got {}'.format(address, amount_btc))
+        outputs.append({ 'address' : address, 'value' : value })
+    return outputs
+
+
+# Payouts below the dust limit of their output, which relays refuse
+def dust_payouts(payouts):
+    return [payout for payout in payouts if payout['value'] < dust_limit(output_script(payout['address']))]
+
+
+# Combine payouts to the same address into one output, keeping the
+# order of first appearance.
+def merge_payouts(payouts):
+    merged = []
+    index = {}
+    for payout in payouts:
+        address = payout['address']
+        if address in index:
+            merged[index[address]]['value'] += payout['value']
+            logger.warning('Merging repeated payout to {}'.format(address))
+        else:
+            index[address] = len(merged)
+            merged.append(dict(payout))
+    return merged
+
+
+# Gather the confirmed UTXOs of wallet entries, each with its input
+# kind and exact vsize. Returns (utxos, privkeys by address) or None.
+def gather_utxos(entries):
+
+    privkeys = {}
+    from_addrs = []
+    for entry in entries:
+        from_addrs.append(entry['address'])
+        privkeys[entry['address']] = entry['privkey']
+
+    # gather UTXOs from inputs with batched requests
+    all_unspent = get_unspent_many(from_addrs)
+    if all_unspent is None:
+        logger.error('Unable to fetch UTXOs')
+        return None
+
+    utxos = []
+    for address in from_addrs:
+        unspent = all_unspent[address]
+        try:
+            kind = input_kind(address, privkeys[address])
+        except ValueError as err:
+            logger.error('Unable to spend from address {}: {}'.format(address, err))
+            return None
+        except Exception:
+            logger.error('Address {} has no valid private key'.format(address))
+            return None
+        logger.debug('Address {} has {} unspent{}'.format(address, len(unspent), pluralize(len(unspent))))
+        has_utxos = False
+        for tx in unspent:
+            utxo = {}
+            utxo['output'] = '{}:{}'.format(tx['id'], tx['vout'])
+            utxo['address'] = address
+            utxo['value'] = tx['amount']
+            utxo['kind'] = kind
+            utxo['segwit'] = (kind == 'p2wpkh')
+            logger.debug('utxo["value"] = {}'.format(utxo['value']))
+            utxos.append(utxo)
+            has_utxos = True
+
+        if not has_utxos:
+            logger.warning('Address {} has no confirmed UTXOs'.format(address))
+
+    # exact input sizes, a legacy input next to SegWit ones also has an
+    # empty witness, a quarter vbyte counted as a whole one
+    witness_pool = any([utxo['segwit'] for utxo in utxos])
+    for utxo in utxos:
+        utxo['size'] = input_vsize(utxo['kind']) + (1 if witness_pool and not utxo['segwit'] else 0)
+
+    return utxos, privkeys
+
+
+# Select inputs from utxos paying every output in payouts, with change
+# back to the address of the last selected input. Returns a dict with
+# the 'inputs', 'outputs', estimated 'vsize' and the 'payouts' it pays,
+# or None if the UTXOs can't cover the payouts.
+def build_payment(utxos, payouts, fee_per_byte, algorithm, btc_price):
+
+    send_satoshi = sum([payout['value'] for payout in payouts])
+    dests = [payout['address'] for payout in payouts]
+    logger.debug('transferring {:,.0f} Satoshi'.format(send_satoshi))
+
+    # upper bounds for selection: the biggest of the destination and
+    # change outputs, plus a vbyte for the SegWit marker and flag
+    witness_pool = any([utxo['segwit'] for utxo in utxos])
+    change_addrs = set([utxo['address'] for utxo in utxos])
+    scripts = [ output_script(address) for address in set(dests) | change_addrs ]
+    sizes = { 'base' : tx_vsize([], []) + (1 if witness_pool else 0),
+              'input' : max([utxo['size'] for utxo in utxos]),
+              'output' : max([output_size(script) for script in scripts]) }
+    budget = config.get('coin-selection-budget', 100000)
+    long_term_fee = config.get('long-term-fee', fee_per_byte)
+    min_change = max([dust_limit(output_script(address)) for address in change_addrs])
+    selection = select_coins(utxos, send_satoshi, fee_per_byte, sizes, algorithm, budget, long_term_fee=long_term_fee, outputs=len(payouts), min_change=min_change)
+
+    # insufficient funds
+    if selection is None:
+        avail_satoshi = sum([utxo['value'] for utxo in utxos])
+        needed = send_satoshi + tx_fee(sizes, fee_per_byte, 0, len(payouts)) + sum([utxo['size'] for utxo in utxos]) * fee_per_byte
+        note = 'after adding miner fees ' if send_satoshi <= avail_satoshi else ''
+        logger.critical('Insufficient funds {}{:,.0f} > {:,.0f}'.format(note, needed, avail_satoshi))
+        return None
+
+    # inputs
+    total = 0
+    txins = selection['inputs']
+    logger.debug('Selected {} input{} using {}'.format(len(txins), pluralize(len(txins)), selection['algorithm']))
+    for n, utxo in enumerate(txins):
+        total += utxo['value']
+        logger.debug('Input {} UTXO {} Value {:,.0f} Total {:,.0f}'.format(n, utxo['output'], utxo['value'], total))
+
+    # selection sized the transaction with upper bounds, charge the
+    # exact vsize and return the difference as change
+    change = selection['change']
+    change_address = txins[-1]['address']
+    scripts = [ output_script(dest) for dest in dests ]
+    if change > 0 and change_address not in dests:
+        scripts.append(output_script(change_address))
+    est_vsize = tx_vsize([utxo['kind'] for utxo in txins], scripts)
+    excess = 0
+    if change > 0:
+        change = total - send_satoshi - est_vsize * fee_per_byte
+    else:
+        excess = total - send_satoshi - est_vsize * fee_per_byte
+    logger.debug('Transaction is at most {} vbytes'.format(est_vsize))
+
+    # outputs
+    txouts = [ dict(payout) for payout in payouts ]
+    for n, txout in enumerate(txouts):
+        logger.debug('OUTPUT {} Address {} Value {:,.0f}'.format(n, txout['address'], txout['value']))
+
+    # trivial remainder condition: it costs more in fees to
+    # use the change than what actually remains, so just
+    # leave it for the miner and a take speed bonus.
+    if excess > 0:
+        excess_usd = (excess/1e8) * btc_price
+        logger.warning('Trivial UTXO remainder released to miner {:,.0f} Satoshi ${:,.2f} USD'.format(excess, excess_usd))
+
+    # return change
+    if (change > 0):
+
+        # merge if change going to a destination address
+        if (change_address in dests):
+            txout = txouts[dests.index(change_address)]
+            txout['value'] += change
+            logger.warning('Change address same as destination, merging output values {:,.0f}'.format(txout['value']))
+
+        # add extra output
+        else:
+            txouts.append( { 'address' : change_address, 'value' : change } )
+            logger.debug('OUTPUT {} Address {} Value {:,.0f}'.format(len(txouts) - 1, change_address, change))
+
+    return { 'inputs' : txins, 'outputs' : txouts, 'vsize' : est_vsize, 'payouts' : payouts }
+
+
+# Build payments for payouts in as few transactions of at most
+# max_vsize vbytes as halving the payouts finds, each spending its own
+# inputs. Returns a list of payments or None.
+def build_payments(utxos, payouts, fee_per_byte, algorithm, btc_price, max_vsize):
+
+    payment = build_payment(utxos, payouts, fee_per_byte, algorithm, btc_price)
+    if payment is None or payment['vsize'] <= max_vsize:
+        return None if payment is None else [payment]
+
+    if len(payouts) == 1:
+        logger.critical('Payment to {} needs {} vbytes, more than the limit of {}'.format(payouts[0]['address'], payment['vsize'], max_vsize))
+        return None
+
+    half = len(payouts) // 2
+    logger.debug('Transaction of {} vbytes exceeds {}, splitting {} payouts'.format(payment['vsize'], max_vsize, len(payouts)))
+    first = build_payments(utxos, payouts[:half], fee_per_byte, algorithm, btc_price, max_vsize)
+    if first is None:
+        return None
 
-    # get current fast confirmation bitcoin fee
-    best_fee = bitcoin_fee()
+    spent = set([utxo['output'] for payment in first for utxo in payment['inputs']])
+    rest = [utxo for utxo in utxos if utxo['output'] not in spent]
+    if len(rest) == 0:
+        logger.critical('Insufficient funds, no UTXOs left for the remaining {} payouts'.format(len(payouts) - half))
+        return None
+    second = build_payments(rest, payouts[half:], fee_per_byte, algorithm, btc_price, max_vsize)
+    if second is None:
+        return None
+    return first + second
+
+
+# Fee sanity checks. Returns the fee in satoshis, or None if the fee is
+# negative, too small or above insane-fee-usd without override.
+def check_fee(txins, txouts, btc_price, override=False):
+
+    sum_ins = sum([x['value'] for x in txins])
+    logger.debug('SUM(inputs) = {:,.0f}'.format(sum_ins))
+
+    sum_outs = sum([x['value'] for x in txouts])
+    logger.debug('SUM(outputs) = {:,.0f}'.format(sum_outs))
+
+    fee_satoshi = (sum_ins - sum_outs)
+    fee_btc = (fee_satoshi/1e8)
+    fee_usd = btc_price * fee_btc
+    logger.info('Paying miner fee of {:,.0f} Satoshi ${:,.2f} USD'.format(fee_satoshi, fee_usd))
+
+    if (fee_usd < 0):
+        logger.critical('Sanity check failed: sum of outputs {:,.0f} exceeds sum of inputs {:,.0f}'.format(sum_outs, sum_ins))
+        return None
+
+    elif (fee_usd < 0.01):
+        logger.critical('Bad transaction: miner fee too small: ${:,.6f}'.format(fee_usd))
+        return None
+
+    if (fee_usd > config['insane-fee-usd']):
+        msg = 'Sanity check failed: miner fee too large ${:,.2f} >= ${:,.2f}'.format(fee_usd, config['insane-fee-usd'])
+        if override:
+            logger.warning(msg)
+            logger.warning('Overriding sanity check')
+        else:
+            logger.error(msg)
+            return None
+
+    return fee_satoshi
+
+
+# Sign a transaction spending txins to txouts and check it's no larger
+# than the est_vsize its fee paid for. Returns the signed hex or None.
+def sign_payment(txins, txouts, privkeys, est_vsize):
+
+    # sign tx inputs, SegWit inputs commit to the value they spend
+    tx = mktx(txins, [ { 'script' : output_script(x['address']), 'value' : x['value'] } for x in txouts ])
+    logger.debug('Signing {} input{}'.format(len(txins), pluralize(len(txins))))
+    witness_values = [ txin['value'] if txin['segwit'] else None for txin in txins ]
+    tx, failed = sign_inputs(tx, [privkeys[txin['address']] for txin in txins], config.get('sign-processes'), witness_values)
+    if failed:
+        for i in failed:
+            logger.critical('Failed to sign UTXO {}'.format(txins[i]['output']))
+        return None
+
+    # the fee was paid on the estimate, which must not be short
+    vsize = signed_vsize(tx)
+    logger.debug('Signed transaction is {} vbytes, estimated {}'.format(vsize, est_vsize))
+    if vsize > est_vsize:
+        logger.critical('Signed transaction is larger than estimated {} > {} vbytes'.format(vsize, est_vsize))
+        return None
+
+    return tx
+
+
+def main():
 
     # command line arguments
     parser = argparse.ArgumentParser(description='Create a Bitcoin transaction')
     parser.add_argument('-f', '--from', help='one of more from addresses', nargs='+', required=True)
-    parser.add_argument('-t', '--to', help='address to send to', nargs=1, required=True)
-    parser.add_argument('-m', '--fee', help='miner fee in Satoshis per byte', nargs=1, type=valid_fee, required=False, default=[best_fee])
+    dest_group = parser.add_mutually_exclusive_group(required=True)
+    dest_group.add_argument('-t', '--to', help='address to send to', nargs=1)
+    dest_group.add_argument('-p', '--payouts', help='CSV (address,amount) or JSONL file of payouts in BTC to send in as few transactions as possible', nargs=1)
+    parser.add_argument('-m', '--fee', help='miner fee in Satoshis per byte, defaults to the current fast confirmation fee', nargs=1, type=valid_fee, required=False)
     parser.add_argument('-b', '--bitcoin', help='amount to transfer in BTC', nargs=1, type=float, required=False)
     parser.add_argument('-u', '--usd', help='amount to transfer in USD', nargs=1, type=float, required=False)
     parser.add_argument('-o', '--override', help='override high fee sanity check', action='store_true', required=False)
+    parser.add_argument('-s', '--selection', help='coin selection algorithm', nargs=1, choices=algorithms, required=False, default=[config.get('coin-selection', 'auto')])
     parser.add_argument('-e', '--envfriendly', help='spend small UXTO amounts first; results in higher fees, but reduces global UTXO DB size', action='store_true', required=False)
     parser.add_argument('-v', '--verbose', help='show verbose output', action='store_true', required=False)
     args = vars(parser.parse_args())
@@ -50,8 +333,13 @@ def main():
     btc_specified = (args['bitcoin'] is not None)
     usd_specified = (args['usd'] is not None)
     amount_satoshi = None
+    payouts = None
 
-    if not (btc_specified or usd_specified):
+    if args['payouts'] is not None:
+        if (btc_specified or usd_specified):
+            logger.error('Payout amounts come from the payout file, don\'t specify an amount')
+            exit(1)
+    elif not (btc_specified or usd_specified):
         sweep = True
         logger.debug('SWEEP all funds')
     elif (btc_specified and usd_specified):
@@ -69,24 +357,53 @@ def main():
         logger.info('AMOUNT {:,.2f} USD = {:,.8f} BTC = {:,.0f} Satoshi'.format(amount_usd, amount_btc, amount_satoshi))
 
 
+    # payout file, every address is checked before anything is built
+    if args['payouts'] is not None:
+        fname = args['payouts'][0]
+        try:
+            payouts = read_payout_file(fname)
+        except (IOError, ValueError, KeyError) as err:
+            logger.error('Unable to read payout file {}: {}'.format(fname, err))
+            exit(1)
+        if len(payouts) == 0:
+            logger.error('No payouts found in {}'.format(fname))
+            exit(1)
+
+        valid = validate_addresses([payout['address'] for payout in payouts])
+        invalid = [address for address in valid if not valid[address]]
+        for address in invalid:
+            logger.error('Payout address "{}" is not a valid Bitcoin address'.format(address))
+        if invalid:
+            exit(1)
+        dust = dust_payouts(payouts)
+        for payout in dust:
+            logger.error('Payout of {:,.0f} Satoshi to {} is below the dust limit'.format(payout['value'], payout['address']))
+        if dust:
+            exit(1)
+
+        payouts = merge_payouts(payouts)
+        dests = [payout['address'] for payout in payouts]
+        amount_satoshi = sum([payout['value'] for payout in payouts])
+        logger.info('PAYOUTS to {} address{} totaling {:,.8f} BTC'.format(len(dests), '' if len(dests) == 1 else 'es', amount_satoshi/1e8))
+
     # substring search for destination address in wallet
-    dest = None
-    item = lookup(args['to'][0])
-    if item is not None:
-        dest = item['address']
-        logger.debug('Found destination address {} {} in wallet'.format(item['name'], dest))
     else:
-        dest = args['to'][0]
-        logger.debug('Using destination address {}'.format(dest))
+        dest = None
+        item = lookup(args['to'][0])
+        if item is not None:
+            dest = item['address']
+            logger.debug('Found destination address {} {} in wallet'.format(item['name'], dest))
+        else:
+            dest = args['to'][0]
+            logger.debug('Using destination address {}'.format(dest))
 
-    if not validate_address(dest):
-        logger.warning('Destination address "{}" is not a valid Bitcoin address'.format(dest))
+        if not validate_address(dest):
+            logger.warning('Destination address "{}" is not a valid Bitcoin address'.format(dest))
+        dests = [dest]
 
 
-    # gather UTXOs from inputs
-    utxos = []
-    privkeys = {}
-    from_addrs = []
+    # find source addresses
+    entries = []
     for source in args['from']:
 
         entry = lookup(source)
@@ -94,28 +411,14 @@ def main():
             logger.error('No source address found in wallet matching "{}"'.format(source))
             exit(1)
 
-        name = entry['name']
-        address = entry['address']
-        privkey = entry['privkey']
-        logger.debug('Found source address {} {} in wallet'.format(name, address))
-        from_addrs.append(address)
-        privkeys[address] = privkey
+        logger.debug('Found source address {} {} in wallet'.format(entry['name'], entry['address']))
+        entries.append(entry)
+    from_addrs = [entry['address'] for entry in entries]
 
-        # gather UTXOs
-        unspent = get_unspent(address)
-        logger.debug('Address {} has {} unspent{}'.format(address, len(unspent), pluralize(len(unspent))))
-        has_utxos = False
-        for tx in unspent:
-            utxo = {}
-            utxo['output'] = '{}:{}'.format(tx['id'], tx['vout'])
-            utxo['address'] = address
-            utxo['value'] = tx['amount']
-            logger.debug('utxo["value"] = {}'.format(utxo['value']))
-            utxos.append(utxo)
-            has_utxos = True
-
-        if not has_utxos:
-            logger.warning('Address {} has no confirmed UTXOs'.format(address))
+    gathered = gather_utxos(entries)
+    if gathered is None:
+        exit(1)
+    utxos, privkeys = gathered
 
     # must have at least one UTXO
     nutxos = len(utxos)
@@ -131,21 +434,29 @@ def main():
     addr_suffix = '' if naddr == 1 else 'es'
     logger.debug('UTXO Summary: {} address{} {} UTXO{} {:,.0f} Satoshi ${:,.2f} USD'.format(naddr, addr_suffix, nutxos, pluralize(nutxos), avail_satoshi, avail_usd))
 
+    # fetch the current fast confirmation fee only if none was given
+    if args['fee'] is None:
+        best_fee = bitcoin_fee()
+        if best_fee is None:
+            logger.error('Unable to fetch the current fee, specify one with -m')
+            exit(1)
+        args['fee'] = [best_fee]
+
     # build tx
-    txins = []
-    txouts = []
     fee_per_byte = int(args['fee'][0])
     logger.debug('Using fee of {} satoshis per byte'.format(fee_per_byte))
 
     # sweep all BTC
     if sweep:
         logger.warning('Sweeping entire {:,.0f} satoshi from all UTXOs'.format(avail_satoshi))
-        est_length = config['len-base'] + (config['len-per-input'] * nutxos) + config['len-per-output']
-        fee = est_length * fee_per_byte
+        est_vsize = tx_vsize([utxo['kind'] for utxo in utxos], [output_script(dest)])
+        fee = est_vsize * fee_per_byte
+        logger.debug('Transaction is at most {} vbytes'.format(est_vsize))
 
         # inputs
         n = 0
         total = 0
+        txins = []
         for utxo in utxos:
             total += utxo['value']
             logger.debug('Input {} UTXO {} Value {:,.0f} Total {:,.0f}'.format(n, utxo['output'], utxo['value'], total))
@@ -156,140 +467,70 @@ def main():
         send_satoshi = avail_satoshi - fee
         txouts = [ {'value' : send_satoshi, 'address' : dest } ]
         logger.debug('OUTPUT 0 Address {} Value {:,.0f}'.format(dest, send_satoshi))
+        payments = [ { 'inputs' : txins, 'outputs' : txouts, 'vsize' : est_vsize, 'payouts' : txouts } ]
 
 
     # transfer specific amount
     else:
-        change_address = None
         send_satoshi = amount_satoshi
-        logger.debug('transferring {:,.0f} Satoshi'.format(send_satoshi))
-
-        initial_fee = (config['len-base'] + (config['len-per-output'] * 2)) * fee_per_byte
-        remaining = send_satoshi + initial_fee
-        total_fees = initial_fee
 
         # Environmentally-friendly transfer spends smallest UTXOs
         # first. This reduces the size of UTXO database each full-node
         # must store, but results in a higher fee.
-        reverse = True
+        algorithm = args['selection'][0]
         if args['envfriendly']:
             logger.warning('environmentally friendly mode active, higher fees apply')
-            reverse = False
-        ordered_utxos = sorted(utxos, key=lambda k: k['value'], reverse=reverse)
-
-        # inputs
-        n = 0
-        total = 0
-        change = 0
-        for utxo in ordered_utxos:
-            fee_inc = (config['len-per-input'] * fee_per_byte)
-            remaining += fee_inc
-            total_fees += fee_inc
-            remaining -= utxo['value']
-            total += utxo['value']
-            logger.debug('Input {} UTXO {} Value {:,.0f} Total {:,.0f}'.format(n, utxo['output'], utxo['value'], total))
-            txins.append(utxo)
-            n += 1
-
-            if remaining < 0:
-                change = -remaining
-                change_address = utxo['address']
-                break
-
-        # insufficient funds
-        if (remaining > 0):
-            note = ''
-            if (remaining <= total_fees):
-                note = 'after adding miner fees '
-		logger.critical('Insufficient funds {}{:,.0f} > {:,.0f}'.format(note, send_satoshi + total_fees, avail_satoshi))
-		exit(1)
-
-        # outputs
-        txouts = [ { 'address' : dest, 'value' : send_satoshi } ]
-        logger.debug('OUTPUT 0 Address {} Value {:,.0f}'.format(dest, send_satoshi))
-
-
-        if (change > 0):
+            algorithm = 'smallest-first'
 
-            # trivial remainder condition: it costs more in fees to
-            # use the UTXO than what actually remains there, so just
-            # leave it for the miner and a take speed bonus.
-
-            sweep_utxo_len = config['len-base'] + config['len-per-input'] + config['len-per-output']
-            sweep_utxo_fee = sweep_utxo_len * best_fee
-            if change < sweep_utxo_fee:
-                change_usd = (change/1e8) * btc_price
-                logger.warning('Trivial UTXO remainder released to miner {:,.0f} Satoshi ${:,.2f} USD'.format(change, change_usd))
-
-            # return change
-            else:
-
-                # merge if change going to dest address
-                if (change_address == dest):
-                    merged_value = send_satoshi + change
-                    logger.warning('Change address same as destination, merging output values {:,.0f}'.format(merged_value))
-                    txouts = [ { 'address' : dest, 'value' : merged_value } ]
-
-                # add extra output
-                else:
-                    txouts.append( { 'address' : change_address, 'value' : change } )
-                    logger.debug('OUTPUT 1 Address {} Value {:,.0f}'.format(change_address, change))
-
-
-    # sanity checks
-    sum_ins = sum([x['value'] for x in txins])
-    logger.debug('SUM(inputs) = {:,.0f}'.format(sum_ins))
-
-    sum_outs = sum([x['value'] for x in txouts])
-    logger.debug('SUM(outputs) = {:,.0f}'.format(sum_outs))
-
-    fee_satoshi = (sum_ins - sum_outs)
-    fee_btc = (fee_satoshi/1e8)
-    fee_usd = btc_price * fee_btc
-    logger.info('Paying miner fee of {:,.0f} Satoshi ${:,.2f} USD'.format(fee_satoshi, fee_usd))
-
-    if (fee_usd < 0):
-        logger.critical('Sanity check failed: sum of outputs {:,.0f} exceeds sum of inputs {:,.0f}'.format(sum_outs, sum_ins))
-        exit(1)
-
-    elif (fee_usd < 0.01):
-        logger.critical('Bad transaction: miner fee too small: ${:,.6f}'.format(fee_usd))
-        exit(1)
-
-    if (fee_usd > config['insane-fee-usd']):
-        msg = 'Sanity check failed: miner fee too large ${:,.2f} >= ${:,.2f}'.format(fee_usd, config['insane-fee-usd'])
-        if args['override']:
-            logger.warning(msg)
-            logger.warning('Overriding sanity check')
+        if payouts is None:
+            payment = build_payment(utxos, [ { 'address' : dest, 'value' : send_satoshi } ], fee_per_byte, algorithm, btc_price)
+            payments = None if payment is None else [payment]
         else:
-            logger.error(msg)
+            max_vsize = config.get('max-tx-vsize', default_max_tx_vsize)
+            payments = build_payments(utxos, payouts, fee_per_byte, algorithm, btc_price, max_vsize)
+        if payments is None:
             exit(1)
 
 
-    # sign tx inputs
-    tx = mktx(txins, txouts)
-    for i in range(len(txins)):
-        logger.debug('Signing input {}'.format(i))
-        try:
-            tx = sign(tx, i, privkeys[txins[i]['address']])
-        except:
-            logger.critical('Failed to sign UTXO {}'.format(txins[i]['output']))
+    # sanity checks and signing, per transaction
+    txs = []
+    fee_satoshi = 0
+    for payment in payments:
+        fee = check_fee(payment['inputs'], payment['outputs'], btc_price, args['override'])
+        if fee is None:
             exit(1)
+        tx = sign_payment(payment['inputs'], payment['outputs'], privkeys, payment['vsize'])
+        if tx is None:
+            exit(1)
+        fee_satoshi += fee
+        txs.append(tx)
 
     # confirm
     send_btc = send_satoshi/1e8
+    fee_btc = fee_satoshi/1e8
+    fee_usd = fee_btc * btc_price
     confirm  = 'Sending {:,.8f} BTC ${:,.2f} USD '.format(send_btc, send_btc * btc_price)
-    confirm += 'from {} to {} '.format(from_addrs, [dest])
+    if len(dests) > 1:
+        confirm += 'from {} to {} addresses in {} transaction{} '.format(from_addrs, len(dests), len(txs), pluralize(len(txs)))
+    else:
+        confirm += 'from {} to {} '.format(from_addrs, dests)
     confirm += 'using fee of {:,.8f} BTC ${:,.2f} USD'.format(fee_btc, fee_usd)
     logger.warning(confirm)
     raw_input('[ Press Enter to confirm ]')
 
-    # submit
-    tid = broadcast(tx)
-    if tid is None:
-        logger.critical('Failed to submit transaction to the network')
-    else:
-        logger.warning('Broadcasted TXID {}'.format(tid))
+    # submit, the transactions spend separate inputs so a failure
+    # doesn't stop the rest
+    failures = 0
+    for tx in txs:
+        tid = broadcast(tx)
+        if tid is None:
+            logger.critical('Failed to submit transaction to the network')
+            failures += 1
+        else:
+            logger.warning('Broadcasted TXID {}'.format(tid))
+
+    if failures:
+        exit(1)
 
 
 if __name__ == "__main__":
@@ -1,26 +1,50 @@
 #!/usr/bin/env python
 
-import sys, os, json, unittest, logging
-from mock import patch
-from validate import validate_address
+import sys, os, json, time, unittest, logging, fcntl, threading
+from mock import patch, Mock
+from validate import validate_address, validate_addresses
 from btclib import config, logger, get_wallet, get_bitcoin_price, lookup
-from btclib import get_cache_path, url_get, get_balance, get_unspent
+from btclib import get_cache_key, cache_get, cache_put, url_get, get_balance, get_unspent
+from btclib import get_session, get_balances, get_unspent_many, tx_is_final, load_config
+from btclib import get_balance_async, http_request, rate_limiter
+from btclib import bitcoin_fee, fee_curve, interpolate_fee
+from btclib import price_quote, price_history, add_prices, price_at
+from btclib import daemon_state, daemon_call, daemon_methods, no_daemon
+import walletd
+from btclib import load_memos, add_memo, add_memos, compact_memos, match_memo_rule
+from btclib import iter_address_txs, sync_ledger, ledger_records, open_ledger, open_db
+from coinselect import select_coins, select_bnb, tx_fee, algorithms
+from bitcoin import mktx, sign, sha256, encode_privkey, privtopub, pubtoaddr
+from txsign import sign_inputs, p2wpkh_address, output_script, signed_txid
+from txsize import input_vsize, output_size, tx_vsize, signed_vsize, input_kind, dust_limit
+from sendbtc import read_payout_file, merge_payouts, dust_payouts, build_payments, sign_payment
+from btclib import load_payout_queue, enqueue_payouts, cancel_payouts, mark_payouts, append_payout_records
+from btclib import release_payouts, locked_payout_queue, send_tx
+from payouts import batch_ready, flush_payouts
+from consolidate import consolidation_candidates, plan_consolidation
 
 logger.setLevel(100)  # suppress logging
+daemon_state['available'] = False  # never forward test calls to a running daemon
 
 
 class TestAddressValidation(unittest.TestCase):
 
     valid_addresses = [ '1PFzobFoKmEnUu2AKJ5JTKrXaR5vh5Ejp6',
                         '1447xMP8SWGEK88DTtQmH35Jn2U3fY6JAG',
-                        '1LCcFfMVa4WnSDxngZhiVzpmCPcCvXMat5'
+                        '1LCcFfMVa4WnSDxngZhiVzpmCPcCvXMat5',
+                        'BC1QW508D6QEJXTDG4Y5R3ZARVARY0C5XW7KV8F3T4',
+                        'bc1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3qccfmv3',
+                        'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0'
                         ]
 
     invalid_addresses = [ '',
                           'NotAnAddress'
                           '19ChmEKxFCMhQTDTniZ2BR7YRgvPz19tu8',
                           '9268FM3VGLR7uvbFEesydGYtCPmc1uDcpx',
-                          '1J9MSBD4z62M2u654XzwavTgtaKdUbigGB'
+                          '1J9MSBD4z62M2u654XzwavTgtaKdUbigGB',
+                          'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t5',
+                          'bc1zw508d6qejxtdg4y5r3zarvaryvqyzf3du',
+                          'tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3q0sl5k7'
                           ]
 
     def test_valid_bitcoin_adresses(self):
@@ -31,6 +55,12 @@ class TestAddressValidation(unittest.TestCase):
         for address in self.invalid_addresses:
             self.assertFalse(validate_address(address), 'False positive')
 
+    def test_validate_addresses_batch(self):
+        addresses = self.valid_addresses + self.invalid_addresses + self.valid_addresses
+        results = validate_addresses(addresses)
+        for address in addresses:
+            self.assertEqual(results[address], validate_address(address), 'batch result differs for {}'.format(address))
+
 
 class TestGetWallet(unittest.TestCase):
 
@@ -50,6 +80,29 @@ class TestGetWallet(unittest.TestCase):
         self.assertEqual(wallet[0]['name'], 'beta')
 
 
+class TestConfigSnapshot(unittest.TestCase):
+
+    def test_snapshot_reused(self):
+        path = '/tmp/basic-wallet-test-{}.conf'.format(os.getpid())
+        with open(path, 'w') as conf:
+            conf.write('wallet:\n  - name : alpha\n    address : 1HsNZvVHem7oSJRNWJ7dwfJ9YeYMwKWm9N\n\nmin-confirmations : 3\n')
+
+        parsed = load_config(path)
+        self.assertEqual(parsed['min-confirmations'], 3)
+        self.assertEqual(parsed['wallet'][0]['name'], 'alpha')
+        self.assertTrue(os.path.isfile(path + '.snapshot'))
+
+        with patch('btclib.yaml.load') as mock_load:
+            cached = load_config(path)
+            self.assertNotIn('wallet', cached.keys(), 'wallet should load lazily')
+            self.assertEqual(cached['wallet'], parsed['wallet'])
+            self.assertEqual(cached['min-confirmations'], 3)
+            self.assertFalse(mock_load.called, 'snapshot should avoid parsing YAML')
+
+        os.remove(path)
+        os.remove(path + '.snapshot')
+
+
 class TestAddressLookup(unittest.TestCase):
 
     def test_lookup(self):
@@ -74,20 +127,82 @@ class TestAddressLookup(unittest.TestCase):
         item = lookup('1LrcWfoypPW8paysq3ruY44Jhe1WgLVZ8Q')
         self.assertEqual(item['name'], 'gamma', 'search by exact address failed')
 
+        item = lookup('et')
+        self.assertEqual(item['name'], 'beta', 'search by short substring failed')
+
+    def test_exact_name_wins(self):
+        config['wallet'] = [ { 'name' : 'savings',
+                               'address' : '1HsNZvVHem7oSJRNWJ7dwfJ9YeYMwKWm9N' },
+                             { 'name' : 'savings old',
+                               'address' : '15bYG3AKp48NcBPZZZZQnASrBmgYZhiTxZ' } ]
+
+        item = lookup('SAVINGS')
+        self.assertEqual(item['address'], '1HsNZvVHem7oSJRNWJ7dwfJ9YeYMwKWm9N')
+
 
 class TestCache(unittest.TestCase):
 
-    def test_get_cache_path(self):
-        global config
-        config['cache-dir'] = '/tmp/cache'
+    def test_get_cache_key(self):
         url = 'http://crypdex.io:3001/insight-api/addr/1GuC79vz3P17LF6KjRG9nC6i41y9b4RXPB/balance'
-        path = get_cache_path(url)
-        self.assertEqual(path, '/tmp/cache/crypdex-io-insight-api-addr-1GuC79vz3P17LF6KjRG9nC6i41y9b4RXPB-balance')
+        key = get_cache_key(url)
+        self.assertEqual(key, 'crypdex.io/insight-api/addr/1GuC79vz3P17LF6KjRG9nC6i41y9b4RXPB/balance')
 
-    def test_get_cache_path_invalid_url(self):
+    def test_get_cache_key_invalid_url(self):
         url = 'this is a malformatted URL'
-        path = get_cache_path(url)
-        self.assertIsNone(path, 'get_cache_path should return None if passed an invalid URL')
+        key = get_cache_key(url)
+        self.assertIsNone(key, 'get_cache_key should return None if passed an invalid URL')
+
+    def test_cache_entry_metadata(self):
+        global config
+        config['cache-dir'] = '/tmp/basic-wallet-test-cache/'
+        url = 'http://example.com/metadata'
+        cache_put(url, 'hello', 200)
+        entry = cache_get(url)
+        self.assertEqual(entry['body'], 'hello')
+        self.assertEqual(entry['status'], 200)
+        self.assertEqual(entry['size'], 5)
+        self.assertTrue(entry['time'] > 0)
+
+    def test_cache_lru_eviction(self):
+        global config
+        config['cache-dir'] = '/tmp/basic-wallet-test-cache/'
+        config['cache-max-bytes'] = 1000
+        cache_put('http://example.com/old', 'x' * 400, 200)
+        cache_put('http://example.com/recent', 'x' * 400, 200)
+        cache_get('http://example.com/old')
+        cache_put('http://example.com/new', 'x' * 400, 200)
+        del config['cache-max-bytes']
+        self.assertIsNotNone(cache_get('http://example.com/old'), 'recently used entry was evicted')
+        self.assertIsNone(cache_get('http://example.com/recent'), 'least recently used entry was not evicted')
+
+    def test_database_lock(self):
+        path = '/tmp/basic-wallet-test-db-{}'.format(os.getpid())
+        opened = []
+        def opener(fname, flag):
+            opened.append(flag)
+            return Mock()
+
+        def try_lock(mode):
+            with open(path + '.lock', 'a') as other:
+                try:
+                    fcntl.flock(other, mode | fcntl.LOCK_NB)
+                    return True
+                except IOError:
+                    return False
+
+        with open_db(opener, path) as db:
+            self.assertFalse(try_lock(fcntl.LOCK_SH), 'creating the database should lock it exclusively')
+        open(path, 'w').close()
+        with open_db(opener, path) as db:
+            self.assertTrue(try_lock(fcntl.LOCK_SH), 'readers should share the lock')
+            self.assertFalse(try_lock(fcntl.LOCK_EX))
+        with open_db(opener, path, True) as db:
+            self.assertFalse(try_lock(fcntl.LOCK_SH))
+        self.assertTrue(try_lock(fcntl.LOCK_EX), 'the lock should be released on close')
+        self.assertEqual(opened, ['c', 'r', 'c'])
+        db.close.assert_called_once_with()
+        os.remove(path)
+        os.remove(path + '.lock')
 
     def test_url_get_with_network_on_cache_off(self):
         global config
@@ -125,9 +240,9 @@ class TestCache(unittest.TestCase):
         # verify directory was created
         self.assertTrue(os.path.isdir(config['cache-dir']))
 
-        # verify cache file exists
-        cache_file = get_cache_path(url)
-        self.assertTrue(os.path.isfile(cache_file))
+        # verify cache entry exists
+        self.assertTrue(os.path.isfile(os.path.join(config['cache-dir'], 'cache.db')))
+        self.assertEqual(cache_get(url)['status'], 200)
 
 
     def test_url_cache_hit(self):
@@ -151,6 +266,257 @@ class TestCache(unittest.TestCase):
         self.assertEqual(satoshi, balance, 'cache read failed')
 
 
+class TestSession(unittest.TestCase):
+
+    def test_session_is_shared(self):
+        self.assertIs(get_session(), get_session(), 'get_session() should reuse one pooled session')
+
+
+class TestImmutableCache(unittest.TestCase):
+
+    @patch('btclib.get_session')
+    def test_final_tx_fetched_once(self, mock_session):
+        global config
+        config['cache-dir'] = '/tmp/basic-wallet-test-cache/'
+        config['networking-enabled'] = True
+        config['final-confirmations'] = 6
+        response = mock_session.return_value.request.return_value
+        response.status_code = 200
+        response.text = json.dumps({ 'txid' : 'final', 'confirmations' : 100 })
+
+        url = 'http://example.com/tx/final-{}'.format(os.getpid())
+        for i in range(3):
+            html = url_get(url, is_immutable=tx_is_final)
+            self.assertEqual(json.loads(html)['txid'], 'final')
+        self.assertEqual(mock_session.return_value.request.call_count, 1, 'final tx should only be fetched once')
+
+    def test_shallow_tx_is_not_final(self):
+        config['final-confirmations'] = 6
+        self.assertFalse(tx_is_final(json.dumps({ 'confirmations' : 2 })))
+        self.assertFalse(tx_is_final('not json'))
+
+
+class TestTransactionPages(unittest.TestCase):
+
+    @patch('btclib.url_get')
+    def test_iter_address_txs_reads_all_pages(self, mock_get):
+        def fake_get(url, use_cache=False):
+            page = int(url.split('pageNum=')[1])
+            return json.dumps({ 'pagesTotal' : 3, 'txs' : [ { 'txid' : '{}-{}'.format(page, i) } for i in range(2) ] })
+        mock_get.side_effect = fake_get
+
+        txids = [tx['txid'] for tx in iter_address_txs('1PiNGDYSiV939f5GDwA7QJix1NZRgviP2H')]
+        self.assertEqual(txids, ['0-0', '0-1', '1-0', '1-1', '2-0', '2-1'])
+        self.assertEqual(mock_get.call_count, 3)
+
+    @patch('btclib.url_get', return_value='Not found')
+    def test_iter_address_txs_bad_page(self, mock_get):
+        self.assertEqual(list(iter_address_txs('1PiNGDYSiV939f5GDwA7QJix1NZRgviP2H')), [None])
+
+
+class TestLedger(unittest.TestCase):
+
+    address = '1PiNGDYSiV939f5GDwA7QJix1NZRgviP2H'
+
+    def make_tx(self, txid, height, confs):
+        return { 'txid' : txid, 'blockheight' : height, 'blocktime' : 1478000000 + height, 'confirmations' : confs,
+                 'vin' : [ { 'addr' : 'someone', 'value' : '1.0' } ],
+                 'vout' : [ { 'value' : '0.5', 'scriptPubKey' : { 'addresses' : [ self.address ] } } ] }
+
+    @patch('btclib.iter_address_txs')
+    def test_incremental_sync(self, mock_iter):
+        global config
+        config['ledger-file'] = '/tmp/basic-wallet-test-ledger-{}'.format(os.getpid())
+        config['final-confirmations'] = 6
+
+        # initial sync stores the full history
+        mock_iter.side_effect = lambda address: iter([ self.make_tx('b', 101, 10), self.make_tx('a', 100, 11) ])
+        self.assertTrue(sync_ledger(self.address))
+        with open_ledger() as db:
+            self.assertEqual(sorted(ledger_records(db, self.address).keys()), ['a', 'b'])
+
+        # later syncs stop at the watermark
+        consumed = []
+        def history(address):
+            for tx in [ self.make_tx('c', 110, 1), self.make_tx('b', 101, 10), self.make_tx('a', 100, 11) ]:
+                consumed.append(tx['txid'])
+                yield tx
+        mock_iter.side_effect = history
+        self.assertTrue(sync_ledger(self.address))
+        self.assertEqual(consumed, ['c', 'b'], 'sync should stop at the first tx below the watermark')
+
+        with open_ledger() as db:
+            records = ledger_records(db, self.address)
+        self.assertEqual(sorted(records.keys()), ['a', 'b', 'c'])
+        self.assertAlmostEqual(records['c']['amount'], 0.5)
+        os.remove(config['ledger-file'])
+        os.remove(config['ledger-file'] + '.lock')
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    @patch('btclib.time.sleep')
+    @patch('btclib.get_session')
+    def test_retry_after_throttling(self, mock_session, mock_sleep):
+        config['rate-limit'] = 10
+        config['max-retries'] = 3
+        throttled = type('Response', (object,), { 'status_code' : 200, 'headers' : {}, 'text' : '{"status":438,"error":"Too many requests"}' })()
+        ok = type('Response', (object,), { 'status_code' : 200, 'headers' : {}, 'text' : '123456' })()
+        mock_session.return_value.request.side_effect = [ throttled, throttled, ok ]
+
+        response = http_request('GET', 'http://example.com/throttled')
+        self.assertEqual(response.text, '123456')
+        self.assertEqual(mock_session.return_value.request.call_count, 3)
+        self.assertTrue(rate_limiter['rate'] < 10, 'throttling should lower the request rate')
+
+
+class TestDaemon(unittest.TestCase):
+
+    def test_no_daemon_running(self):
+        config['daemon-socket'] = '/tmp/basic-wallet-test-missing.sock'
+        daemon_state['available'] = None
+        self.assertIs(daemon_call('get_balance', ['1PiNGDYSiV939f5GDwA7QJix1NZRgviP2H'], {}), no_daemon)
+        self.assertFalse(daemon_state['available'])
+
+    def test_socket_in_use(self):
+        path = '/tmp/basic-wallet-test-{}.sock'.format(os.getpid())
+        server = walletd.Server(path, walletd.RequestHandler)
+        try:
+            self.assertTrue(walletd.socket_in_use(path))
+            server.server_close()
+            self.assertFalse(walletd.socket_in_use(path), 'a socket left by a dead daemon is stale')
+        finally:
+            server.server_close()
+            os.remove(path)
+
+    def test_quotes_reused(self):
+        config['daemon-quote-ttl'] = 60
+        with patch.object(walletd, 'quotes', {}):
+            with patch.dict(daemon_methods, { 'get_bitcoin_price' : lambda use_cache=False: 700.0 }):
+                self.assertEqual(walletd.dispatch('get_bitcoin_price', [], {}), 700.0)
+                daemon_methods['get_bitcoin_price'] = lambda use_cache=False: 800.0
+                self.assertEqual(walletd.dispatch('get_bitcoin_price', [], {}), 700.0, 'quote should come from the daemon cache')
+
+
+class TestFeeOracle(unittest.TestCase):
+
+    def setUp(self):
+        fee_curve.update({ 'curve' : None, 'time' : 0 })
+        config['networking-enabled'] = True
+
+    def tearDown(self):
+        fee_curve.update({ 'curve' : None, 'time' : 0 })
+
+    def test_interpolation(self):
+        curve = { 1 : 100.0, 3 : 60.0, 6 : 30.0 }
+        self.assertEqual(interpolate_fee(curve, 2), 80.0)
+        self.assertEqual(interpolate_fee(curve, 4), 50.0)
+        self.assertEqual(interpolate_fee(curve, 0), 100.0, 'targets below the curve use the fastest fee')
+        self.assertEqual(interpolate_fee(curve, 24), 30.0, 'targets above the curve use the slowest fee')
+
+    @patch('btclib.cache_put')
+    @patch('btclib.cache_get', return_value=None)
+    @patch('btclib.http_request')
+    def test_curve_fetched_once(self, mock_request, mock_cache_get, mock_cache_put):
+        mock_request.return_value.status_code = 200
+        mock_request.return_value.text = '{"feeByBlockTarget": {"2": 50000, "6": 20000}}'
+        self.assertEqual(bitcoin_fee(2), 50.0)
+        self.assertEqual(bitcoin_fee(6), 20.0)
+        self.assertEqual(bitcoin_fee(4), 35.0)
+        self.assertEqual(mock_request.call_count, 1, 'one request should serve every block target')
+
+    @patch('btclib.cache_get', return_value=None)
+    @patch('btclib.http_request', return_value=None)
+    def test_last_known_curve(self, mock_request, mock_cache_get):
+        config['fee-curve-ttl'] = 300
+        fee_curve.update({ 'curve' : { 2 : 42.0 }, 'time' : 1 })
+        self.assertEqual(bitcoin_fee(2), 42.0)
+        self.assertEqual(mock_request.call_args[1]['retries'], 0, 'a known curve should not wait on retries')
+
+
+class TestMemos(unittest.TestCase):
+
+    def setUp(self):
+        config['memo-file'] = '/tmp/basic-wallet-test-memos-{}'.format(os.getpid())
+
+    def tearDown(self):
+        for fname in [config['memo-file'], config['memo-file'] + '.json', config['memo-file'] + '.lock']:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def test_append_and_load(self):
+        add_memo('e18f8d62dedd0dafb68fb82c468ef1a2f14040d249738f42538e332f16829417', 'first')
+        add_memo('e18f8d62dedd0dafb68fb82c468ef1a2f14040d249738f42538e332f16829417', 'second')
+        add_memo('83418bf5129ff55d9778ba50e7563cefebf072dfa2404b05d3ff1665aee3', 'other')
+        memos = load_memos()
+        self.assertEqual(memos, { 'e18f8d62dedd0daf' : 'second', '83418bf5129ff55d' : 'other' })
+
+        with open(config['memo-file']) as mfile:
+            self.assertEqual(len(mfile.readlines()), 3, 'memos should be appended, not rewritten')
+
+        compact_memos()
+        with open(config['memo-file']) as mfile:
+            self.assertEqual(len(mfile.readlines()), 2)
+        self.assertEqual(load_memos(), memos)
+
+    # another process compacting holds the lock until its file is in place
+    def test_add_waits_for_other_process(self):
+        add_memo('e18f8d62dedd0dafb68fb82c468ef1a2f14040d249738f42538e332f16829417', 'first')
+        with open(config['memo-file'] + '.lock', 'a') as other:
+            fcntl.flock(other, fcntl.LOCK_EX)
+            worker = threading.Thread(target=add_memo, args=('83418bf5129ff55d9778ba50e7563cefebf072dfa2404b05d3ff1665aee3', 'other'))
+            worker.start()
+            worker.join(0.2)
+            self.assertTrue(worker.is_alive(), 'adding a memo should wait for the memo file lock')
+            with open(config['memo-file'] + '.tmp', 'w') as mfile:
+                mfile.write('{"txid": "e18f8d62dedd0daf", "memo": "compacted"}\n')
+            os.rename(config['memo-file'] + '.tmp', config['memo-file'])
+        worker.join()
+        self.assertEqual(load_memos(), { 'e18f8d62dedd0daf' : 'compacted', '83418bf5129ff55d' : 'other' })
+
+    def test_batched_add(self):
+        memos = dict(('{:064x}'.format(i << 200), 'memo {}'.format(i)) for i in range(500))
+        add_memos(memos)
+        self.assertEqual(len(load_memos()), 500)
+
+    def test_match_memo_rule(self):
+        config['wallet'] = [ { 'name' : 'Mining Pool',
+                               'address' : '1KvbFkaB6uxxZprQNWZuFtHa9PfqrfSUZ3' },
+                             { 'name' : 'Checking',
+                               'address' : '1GT2eXn1ww6feHUUhSAzMU5sNwzkzETLY3' } ]
+        rules = [ { 'address' : '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', 'memo' : 'Genesis' },
+                  { 'name' : 'mining', 'memo' : 'Mining payout' } ]
+
+        rec = { 'counterparties' : [ '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa' ] }
+        self.assertEqual(match_memo_rule(rules, rec, '1GT2eXn1ww6feHUUhSAzMU5sNwzkzETLY3'), 'Genesis')
+
+        rec = { 'counterparties' : [ '1KvbFkaB6uxxZprQNWZuFtHa9PfqrfSUZ3' ] }
+        self.assertEqual(match_memo_rule(rules, rec, '1GT2eXn1ww6feHUUhSAzMU5sNwzkzETLY3'), 'Mining payout')
+
+        rec = { 'counterparties' : [ '12c6DSiU4Rq3P4ZxziKxzrL5LmMBrzjrJX' ] }
+        self.assertIsNone(match_memo_rule(rules, rec, '1GT2eXn1ww6feHUUhSAzMU5sNwzkzETLY3'))
+
+    def test_import_legacy_file(self):
+        with open(config['memo-file'], 'w') as mfile:
+            mfile.write(json.dumps({ 'e18f8d62dedd0dafb68fb82c468ef1a2f14040d249738f42538e332f16829417' : 'legacy' }, indent=4))
+        self.assertEqual(load_memos(), { 'e18f8d62dedd0daf' : 'legacy' })
+        self.assertTrue(os.path.isfile(config['memo-file'] + '.json'), 'original memo file should be kept')
+
+    def test_file_replaced_by_another_process(self):
+        add_memos(dict(('{:064x}'.format(i << 200), 'memo {}'.format(i)) for i in range(20)))
+        self.assertEqual(len(load_memos()), 20)
+
+        # another process compacts into a new file and appends past our offset
+        tmp = config['memo-file'] + '.other'
+        with open(tmp, 'w') as mfile:
+            for i in range(30):
+                mfile.write(json.dumps({ 'txid' : '{:064x}'.format((i + 100) << 200), 'memo' : 'a much longer memo {}'.format(i) }) + '\n')
+        os.rename(tmp, config['memo-file'])
+        memos = load_memos()
+        self.assertEqual(len(memos), 30)
+        self.assertEqual(memos['{:064x}'.format(100 << 200)[:16]], 'a much longer memo 0')
+
+
 class TestGetBalance(unittest.TestCase):
 
     def test_get_sentinel_balance(self):
@@ -164,6 +530,55 @@ class TestGetBalance(unittest.TestCase):
         self.assertIsNone(bal, 'get_balance() returned {} instead of None when passed an invalid address'.format(bal))
 
 
+    @patch('btclib.get_balance', side_effect=lambda address, use_cache: len(address))
+    def test_get_balances_keeps_order(self, mock_balance):
+        config['batch-size'] = 1
+        addresses = ['a' * n for n in range(1, 21)]
+        balances = get_balances(addresses, threads=4)
+        self.assertEqual(balances, range(1, 21), 'get_balances() must return results in input order')
+
+
+    @patch('btclib.url_get', side_effect=lambda url, use_cache=False: str(len(url)))
+    def test_get_balance_async_fan_out(self, mock_get):
+        addresses = ['1' * n for n in range(1, 51)]
+        pending = [get_balance_async(a) for a in addresses]
+        balances = [p.get() for p in pending]
+        self.assertEqual(balances, [get_balance(a) for a in addresses])
+
+
+class TestPriceHistory(unittest.TestCase):
+
+    def setUp(self):
+        config['price-history-file'] = '/tmp/basic-wallet-test-prices-{}'.format(os.getpid())
+        config['price-ttl'] = 60
+        price_history['path'] = None
+        price_quote.update({ 'price' : None, 'time' : 0 })
+
+    def tearDown(self):
+        if os.path.isfile(config['price-history-file']):
+            os.remove(config['price-history-file'])
+        price_history['path'] = None
+        price_quote.update({ 'price' : None, 'time' : 0 })
+
+    def test_price_at(self):
+        day = 24 * 3600
+        add_prices([ (1000000 + 10 * day, 900.0), (1000000, 700.0), (1000000 + day, 800.0) ])
+        self.assertEqual(price_at(1000000 + 3600), 700.0)
+        self.assertEqual(price_at(1000000 + day - 3600), 800.0)
+        self.assertIsNone(price_at(1000000 + 18 * day), 'samples over a week away should not be used')
+
+        # reloaded from disk
+        price_history['path'] = None
+        self.assertEqual(list(price_at(1000000 + d * day) for d in (0, 1, 10)), [700.0, 800.0, 900.0])
+
+    @patch('btclib.url_get', return_value='{"status":200,"data":{"bitstamp":700}}')
+    def test_quote_reused(self, mock_get):
+        self.assertEqual(get_bitcoin_price(), 700.0)
+        self.assertEqual(get_bitcoin_price(), 700.0)
+        self.assertEqual(mock_get.call_count, 1, 'a fresh quote should not be fetched again')
+        self.assertEqual(price_at(time.time()), 700.0, 'quotes should be recorded in the price history')
+
+
 class TestPriceFetch(unittest.TestCase):
 
     def test_get_bitcoin_price(self):
@@ -180,10 +595,357 @@ class TestGetUnspent(unittest.TestCase):
         fetched_utxos = get_unspent(sentinel)
         self.assertEqual(actual_utxos, fetched_utxos, 'get_unspent("{}") is {} but should be {}'.format(sentinel, fetched_utxos, actual_utxos))
 
+    @patch('btclib.url_get')
+    def test_get_unspent_many_splits_by_address(self, mock_get):
+        config['batch-size'] = 2
+        config['min-confirmations'] = 1
+        def fake_get(url, use_cache=False):
+            addrs = url.split('/addrs/')[1].split('/')[0].split(',')
+            return json.dumps([ { 'address' : a, 'txid' : a * 2, 'vout' : 0, 'satoshis' : 1000, 'confirmations' : 6 } for a in addrs ])
+        mock_get.side_effect = fake_get
+
+        addresses = ['a', 'b', 'c', 'd', 'e']
+        unspent = get_unspent_many(addresses)
+        self.assertEqual(mock_get.call_count, 3, 'five addresses in chunks of two should cost three requests')
+        for a in addresses:
+            self.assertEqual(unspent[a], [ { 'id' : a * 2, 'vout' : 0, 'amount' : 1000 } ])
+
     def test_get_utxos_invalid_address(self):
         bal = get_unspent('16YJG2tGrAhe4NPHeDfzwfmSkF16Mdzb2w')
         self.assertIsNone(bal, 'get_unspent() returned {} instead of None when passed an invalid address'.format(bal))
 
 
+class TestCoinSelection(unittest.TestCase):
+
+    sizes = { 'base' : 10, 'input' : 180, 'output' : 34 }
+
+    def test_bnb_finds_changeless_match(self):
+        fee = tx_fee(self.sizes, 1, 2, 1)
+        utxos = [ { 'value' : v } for v in (50000, 30000 + fee - 20000, 20000, 90000) ]
+        selection = select_coins(utxos, 30000, 1, self.sizes)
+        self.assertEqual(selection['algorithm'], 'bnb')
+        self.assertEqual(selection['change'], 0)
+        self.assertEqual(selection['excess'], 0)
+        self.assertEqual(sorted([u['value'] for u in selection['inputs']]), [10000 + fee, 20000])
+
+    def test_fee_accounting(self):
+        utxos = [ { 'value' : v } for v in (123456, 234567, 345678, 456789) ]
+        for algorithm in algorithms:
+            selection = select_coins(utxos, 400000, 20, self.sizes, algorithm)
+            total = sum([u['value'] for u in selection['inputs']])
+            self.assertEqual(total, 400000 + selection['change'] + selection['fee'], algorithm)
+            outputs = 2 if selection['change'] else 1
+            self.assertTrue(selection['fee'] >= tx_fee(self.sizes, 20, len(selection['inputs']), outputs), algorithm)
+
+    def test_change_above_dust(self):
+        sizes = { 'base' : 10, 'input' : 148, 'output' : 34 }
+        self.assertEqual(select_coins([ { 'value' : 100000 } ], 99400, 1, sizes)['change'], 374)
+        selection = select_coins([ { 'value' : 100000 } ], 99400, 1, sizes, min_change=546)
+        self.assertEqual(selection['change'], 0)
+        self.assertEqual(selection['fee'], 600)
+
+    # cheaper inputs than later make bigger sets less wasteful
+    def test_bnb_negative_input_waste(self):
+        pool = [ (v, { 'value' : v }) for v in (47, 39, 35, 29, 25, 22, 19) ]
+        chosen = select_bnb(pool, 95, 3, input_waste=-1)
+        total = sum([u['value'] for u in chosen])
+        self.assertEqual(total - 95 - len(chosen), -4)
+
+    def test_insufficient_funds(self):
+        utxos = [ { 'value' : 10000 }, { 'value' : 20000 } ]
+        for algorithm in algorithms:
+            self.assertIsNone(select_coins(utxos, 30000, 1, self.sizes, algorithm), algorithm)
+
+
+class TestSignInputs(unittest.TestCase):
+
+    def test_matches_serial_signing(self):
+        privkeys = [ sha256('key a'), encode_privkey(sha256('key b'), 'wif_compressed'), encode_privkey(sha256('key c'), 'wif') ]
+        txins = [ { 'output' : '{:064x}:{}'.format(i * 7919 + 1, i % 3), 'value' : 10000 } for i in range(20) ]
+        tx = mktx(txins, [ { 'address' : '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', 'value' : 150000 } ])
+        keys = [ privkeys[i % 3] for i in range(20) ]
+
+        serial = tx
+        for i in range(20):
+            serial = sign(serial, i, keys[i])
+        for processes in (1, 2):
+            signed, failed = sign_inputs(tx, keys, processes)
+            self.assertEqual(failed, [])
+            self.assertEqual(signed, serial, 'sign_inputs with {} processes differs from serial signing'.format(processes))
+
+    # native P2WPKH example from BIP 143
+    def test_witness_input(self):
+        tx = ('0100000002fff7f7881a8099afa6940d42d1e7f6362bec38171ea3edf433541db4e4ad969f0000000000eeffffffef51e1b804cc89d182d27965'
+              '5c3aa89e815b1b309fe287d9b2b55d57b90ec68a0100000000ffffffff02202cb206000000001976a9148280b37df378db99f66f85c95a783a76'
+              'ac7a6d5988ac9093510d000000001976a9143bde42dbee7e4dbe6a21b2d50ce2f0167faa815988ac11000000')
+        privkeys = [ 'bbc27228ddcb9209d7fd6f36b02f7dfa6252af40bb2f1cbc7a557da8027ff866',
+                     '619c335025c7f4012e556c2a58b2506e30b8511b53ade95ea316fd8c3286feb9' ]
+        signed, failed = sign_inputs(tx, privkeys, 1, [None, 600000000])
+        self.assertEqual(failed, [])
+        self.assertTrue(signed.startswith('01000000000102'), 'missing SegWit marker and flag')
+        witness = ('0247304402203609e17b84f6a7d30c80bfa610b5b4542f32a8a0d5447a12fb1366d7f01cc44a0220573a954c4518331561406f'
+                   '90300e8f3358f51928d43c212a8caed02de67eebee0121025476c2e83188368da1ff3e292e7acafcdb3566bb0ad253f62fc70f07aeee6357')
+        self.assertTrue(signed.endswith(witness + '11000000'), 'witness differs from BIP 143')
+
+        address = p2wpkh_address('025476c2e83188368da1ff3e292e7acafcdb3566bb0ad253f62fc70f07aeee6357')
+        self.assertEqual(output_script(address), '00141d0f172a0ecb48aee1be1f2687d2963ae33f71a1')
+
+
+class TestTxSize(unittest.TestCase):
+
+    def test_component_sizes(self):
+        self.assertEqual(input_vsize('p2pkh'), 148)
+        self.assertEqual(input_vsize('p2pkh-uncompressed'), 180)
+        self.assertEqual(input_vsize('p2wpkh'), 68)
+        self.assertEqual(output_size(output_script('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa')), 34)
+        self.assertEqual(output_size(output_script('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4')), 31)
+        self.assertEqual(dust_limit(output_script('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa')), 546)
+        self.assertEqual(dust_limit(output_script('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4')), 294)
+        self.assertEqual(dust_limit(output_script('bc1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3qccfmv3')), 330)
+
+    def test_input_kind(self):
+        privkey = encode_privkey(sha256('key a'), 'wif_compressed')
+        self.assertEqual(input_kind('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4', privkey), 'p2wpkh')
+        self.assertEqual(input_kind('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', privkey), 'p2pkh')
+        self.assertEqual(input_kind('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', encode_privkey(sha256('key a'), 'wif')), 'p2pkh-uncompressed')
+
+        # P2WSH and Taproot outputs aren't signed as P2WPKH
+        for address in ('bc1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3qccfmv3',
+                        'bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0'):
+            self.assertTrue(validate_address(address))
+            self.assertRaises(ValueError, input_kind, address, privkey)
+
+    def test_estimate_bounds_signed_size(self):
+        privkeys = [ encode_privkey(sha256('key a'), 'wif_compressed'), encode_privkey(sha256('key b'), 'wif') ]
+        addresses = [ p2wpkh_address(privtopub(privkeys[0])), pubtoaddr(privtopub(privkeys[0])), pubtoaddr(privtopub(privkeys[1])) ]
+        keys = [ privkeys[0], privkeys[0], privkeys[1] ]
+
+        txins = [ { 'output' : '{:064x}:{}'.format(i * 7919 + 1, i), 'value' : 10000 } for i in range(12) ]
+        scripts = [ output_script(addresses[0]), output_script(addresses[1]) ]
+        tx = mktx(txins, [ { 'script' : script, 'value' : 5000 } for script in scripts ])
+        kinds = [ input_kind(addresses[i % 3], keys[i % 3]) for i in range(12) ]
+        witness_values = [ 10000 if kind == 'p2wpkh' else None for kind in kinds ]
+
+        signed, failed = sign_inputs(tx, [keys[i % 3] for i in range(12)], 1, witness_values)
+        estimate = tx_vsize(kinds, scripts)
+        vsize = signed_vsize(signed)
+        self.assertTrue(vsize <= estimate, 'signed {} vbytes exceeds estimate {}'.format(vsize, estimate))
+        self.assertTrue(estimate - vsize <= len(txins), 'estimate {} is loose for {} vbytes'.format(estimate, vsize))
+
+
+class TestSendMany(unittest.TestCase):
+
+    def setUp(self):
+        self.fname = '/tmp/basic-wallet-test-payouts-{}'.format(os.getpid())
+
+    def tearDown(self):
+        for fname in [self.fname + '.csv', self.fname + '.jsonl']:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def test_read_payout_file(self):
+        with open(self.fname + '.csv', 'w') as pfile:
+            pfile.write('address,amount\n1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa,0.001\nbc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4, 0.5\n')
+        with open(self.fname + '.jsonl', 'w') as pfile:
+            pfile.write('{"address": "1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa", "amount": 0.001}\n\n')
+            pfile.write('{"address": "bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4", "amount": 0.5}\n')
+        expected = [ { 'address' : '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', 'value' : 100000 },
+                     { 'address' : 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4', 'value' : 50000000 } ]
+        self.assertEqual(read_payout_file(self.fname + '.csv'), expected)
+        self.assertEqual(read_payout_file(self.fname + '.jsonl'), expected)
+        self.assertEqual(merge_payouts(expected + expected[:1])[0]['value'], 200000)
+
+    def test_dust_payouts(self):
+        payouts = [ { 'address' : '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', 'value' : 545 },
+                    { 'address' : '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', 'value' : 546 },
+                    { 'address' : 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4', 'value' : 300 } ]
+        self.assertEqual(dust_payouts(payouts), payouts[:1])
+
+    def test_split_under_size_limit(self):
+        privkey = encode_privkey(sha256('key a'), 'wif_compressed')
+        source = pubtoaddr(privtopub(privkey))
+        utxos = [ { 'output' : '{:064x}:0'.format(i + 1), 'address' : source, 'value' : 200000, 'kind' : 'p2pkh',
+                    'segwit' : False, 'size' : input_vsize('p2pkh') } for i in range(20) ]
+        payouts = [ { 'address' : pubtoaddr(privtopub(sha256('payee {}'.format(i)))), 'value' : 50000 } for i in range(60) ]
+
+        payments = build_payments(utxos, payouts, 10, 'auto', 1000.0, 1000)
+        self.assertTrue(len(payments) > 1)
+        spent = [utxo['output'] for payment in payments for utxo in payment['inputs']]
+        self.assertEqual(len(spent), len(set(spent)), 'transactions share inputs')
+
+        paid = []
+        for payment in payments:
+            self.assertTrue(payment['vsize'] <= 1000)
+            ins = sum([utxo['value'] for utxo in payment['inputs']])
+            outs = sum([txout['value'] for txout in payment['outputs']])
+            self.assertTrue(ins - outs >= payment['vsize'] * 10)
+            paid += [txout for txout in payment['outputs'] if txout['address'] != source]
+        self.assertEqual(paid, payouts)
+
+
+class TestPayoutQueue(unittest.TestCase):
+
+    privkey = encode_privkey(sha256('key a'), 'wif_compressed')
+
+    def setUp(self):
+        config['payout-queue-file'] = '/tmp/basic-wallet-test-payouts-{}'.format(os.getpid())
+        self.insane_fee_usd = config['insane-fee-usd']
+
+    def tearDown(self):
+        config['insane-fee-usd'] = self.insane_fee_usd
+        for fname in [config['payout-queue-file'], config['payout-queue-file'] + '.lock']:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def utxos(self):
+        source = pubtoaddr(privtopub(self.privkey))
+        return [ { 'output' : '{:064x}:0'.format(i + 1), 'address' : source, 'value' : 500000, 'kind' : 'p2pkh',
+                   'segwit' : False, 'size' : input_vsize('p2pkh') } for i in range(3) ], { source : self.privkey }
+
+    def test_enqueue_and_cancel(self):
+        ids = enqueue_payouts([ { 'address' : '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', 'value' : 10000 },
+                                { 'address' : 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4', 'value' : 20000 } ])
+        self.assertEqual(cancel_payouts([ids[0], 'unknown']), [ids[0]])
+        mark_payouts('sending', [ids[1]], 'ab' * 32)
+
+        # a crash can leave half a record at the end
+        with open(config['payout-queue-file'], 'a') as qfile:
+            qfile.write('{"op": "cancel", "id"')
+        queue = load_payout_queue()
+        self.assertEqual([p['state'] for p in queue], ['cancelled', 'sending'])
+        self.assertEqual(queue[1]['txid'], 'ab' * 32)
+        self.assertEqual(cancel_payouts([ids[1]]), [])
+
+    def test_batch_thresholds(self):
+        now = time.time()
+        self.assertFalse(batch_ready([], now))
+        self.assertFalse(batch_ready([ { 'time' : now } ], now))
+        self.assertTrue(batch_ready([ { 'time' : now } ] * config.get('payout-batch-count', 50), now))
+        self.assertTrue(batch_ready([ { 'time' : now - config.get('payout-batch-age', 3600) } ], now))
+
+    def test_flush_sends_one_transaction(self):
+        payees = [ pubtoaddr(privtopub(sha256('payee {}'.format(i)))) for i in range(5) ]
+        ids = enqueue_payouts([ { 'address' : payee, 'value' : 20000 } for payee in payees + payees[:1] ])
+        sent = []
+        with patch('payouts.gather_utxos', return_value=self.utxos()), patch('payouts.get_bitcoin_price', return_value=1000.0), \
+             patch('payouts.send_tx', side_effect=lambda tx: (sent.append(tx) or 'txid', False)):
+            config['insane-fee-usd'] = 0.01
+            self.assertEqual(flush_payouts([], 10, force=True), 0)
+            self.assertEqual(set([p['state'] for p in load_payout_queue()]), set(['pending']))
+
+            config['insane-fee-usd'] = 10.0
+            self.assertEqual(flush_payouts([], 10), 0, 'batch thresholds not reached')
+            self.assertEqual(flush_payouts([], 10, force=True), len(ids))
+
+        self.assertEqual(len(sent), 1)
+        queue = load_payout_queue()
+        self.assertEqual(set([p['state'] for p in queue]), set(['sent']))
+        self.assertEqual(set([p['txid'] for p in queue]), set([signed_txid(sent[0])]))
+
+    def test_unanswered_broadcast_is_not_resent(self):
+        payees = [ pubtoaddr(privtopub(sha256('payee {}'.format(i)))) for i in range(3) ]
+        enqueue_payouts([ { 'address' : payee, 'value' : 20000 } for payee in payees ])
+        pushed = []
+        with patch('payouts.gather_utxos', return_value=self.utxos()), patch('payouts.get_bitcoin_price', return_value=1000.0):
+
+            # refused outright, the batch would only be refused again
+            with patch('payouts.send_tx', side_effect=lambda tx: pushed.append(tx) or (None, True)):
+                self.assertEqual(flush_payouts([], 10, force=True), 0)
+                self.assertEqual(flush_payouts([], 10, force=True), 0)
+            self.assertEqual(len(pushed), 1, 'a rejected batch was sent again')
+            self.assertEqual(set([p['state'] for p in load_payout_queue()]), set(['rejected']))
+
+            # a timeout may have reached the network
+            enqueue_payouts([ { 'address' : payee, 'value' : 20000 } for payee in payees ])
+            with patch('payouts.send_tx', side_effect=lambda tx: pushed.append(tx) or (None, False)):
+                self.assertEqual(flush_payouts([], 10, force=True), 0)
+                self.assertEqual(flush_payouts([], 10, force=True), 0)
+            self.assertEqual(len(pushed), 2, 'payouts of an unanswered broadcast were sent again')
+            self.assertEqual([p['state'] for p in load_payout_queue()], ['rejected'] * 3 + ['sending'] * 3)
+
+        self.assertEqual(len(release_payouts(signed_txid(pushed[1]))), 3)
+        self.assertEqual([p['state'] for p in load_payout_queue()], ['rejected'] * 3 + ['pending'] * 3)
+
+    def test_flush_without_price(self):
+        enqueue_payouts([ { 'address' : pubtoaddr(privtopub(sha256('payee'))), 'value' : 20000 } ])
+        send = Mock(return_value=('txid', False))
+        with patch('payouts.gather_utxos', return_value=self.utxos()), patch('payouts.get_bitcoin_price', return_value=None), \
+             patch('payouts.send_tx', send):
+            self.assertEqual(flush_payouts([], 10, force=True), 0)
+        self.assertFalse(send.called)
+        self.assertEqual(load_payout_queue()[0]['state'], 'pending')
+
+    # a proxy error may come back after the node accepted the transaction
+    def test_send_tx_rejection(self):
+        networking = config['networking-enabled']
+        config['networking-enabled'] = True
+        try:
+            for status, rejected in ((400, True), (429, False), (502, False), (503, False)):
+                with patch('btclib.http_request', return_value=Mock(status_code=status, text='error')):
+                    self.assertEqual(send_tx('00'), (None, rejected), status)
+        finally:
+            config['networking-enabled'] = networking
+
+    def test_cancel_waits_for_flush(self):
+        ids = enqueue_payouts([ { 'address' : pubtoaddr(privtopub(sha256('payee'))), 'value' : 20000 } ])
+        done = []
+        with locked_payout_queue():
+            worker = threading.Thread(target=lambda: done.append(cancel_payouts(ids)))
+            worker.start()
+            worker.join(0.2)
+            self.assertEqual(done, [], 'cancel should wait for the queue lock')
+        worker.join()
+        self.assertEqual(done, [ids])
+
+    def test_flush_skips_payouts_cancelled_meanwhile(self):
+        ids = enqueue_payouts([ { 'address' : pubtoaddr(privtopub(sha256('payee'))), 'value' : 20000 } ])
+        def sign_and_cancel(*args):
+            append_payout_records([ { 'op' : 'cancel', 'id' : ids[0] } ])
+            return sign_payment(*args)
+        send = Mock(return_value=('txid', False))
+        with patch('payouts.gather_utxos', return_value=self.utxos()), patch('payouts.get_bitcoin_price', return_value=1000.0), \
+             patch('payouts.sign_payment', side_effect=sign_and_cancel), patch('payouts.send_tx', send):
+            self.assertEqual(flush_payouts([], 10, force=True), 0)
+        self.assertFalse(send.called)
+        self.assertEqual(load_payout_queue()[0]['state'], 'cancelled')
+
+
+class TestConsolidation(unittest.TestCase):
+
+    def utxos(self, address, kind, values):
+        return [ { 'output' : '{:064x}:{}'.format(hash(address) & 0xffffffff, i), 'address' : address, 'value' : value,
+                   'kind' : kind, 'segwit' : kind == 'p2wpkh', 'size' : input_vsize(kind) } for i, value in enumerate(values) ]
+
+    def test_candidates(self):
+        utxos = self.utxos('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', 'p2pkh', [ 1000, 5000, 900000, 2000000 ])
+        self.assertEqual([u['value'] for u in consolidation_candidates(utxos, 10, 1000000)], [5000, 900000])
+
+    def test_plan(self):
+        legacy = self.utxos('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', 'p2pkh', range(10000, 110000, 10000))
+        segwit = self.utxos('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4', 'p2wpkh', [ 30000, 20000 ])
+
+        payments = plan_consolidation(legacy + segwit, 5)
+        self.assertEqual(sorted([len(p['inputs']) for p in payments]), [2, 10])
+        for payment in payments:
+            self.assertEqual(len(payment['outputs']), 1)
+            self.assertEqual(payment['outputs'][0]['address'], payment['inputs'][0]['address'])
+            total = sum([u['value'] for u in payment['inputs']])
+            self.assertEqual(total - payment['outputs'][0]['value'], payment['vsize'] * 5)
+
+        self.assertEqual(len(plan_consolidation(legacy + segwit, 5, min_inputs=3)), 1)
+        merged = plan_consolidation(legacy + segwit, 5, '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa')
+        self.assertEqual([len(p['inputs']) for p in merged], [12])
+
+        # twelve 800 satoshi UTXOs merge into 500 satoshis, which is dust
+        dust = self.utxos('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa', 'p2pkh', [ 800 ] * 12)
+        self.assertEqual(plan_consolidation(dust, 5), [])
+        self.assertEqual(len(plan_consolidation(dust, 4)), 1)
+
+        limited = plan_consolidation(legacy, 5, max_vsize=650)
+        self.assertTrue(len(limited) > 1)
+        self.assertTrue(all([p['vsize'] <= 650 for p in limited]))
+        self.assertEqual(sum([len(p['inputs']) for p in limited]), len(legacy))
+
+
 if __name__ == '__main__':
     unittest.main()
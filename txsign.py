@@ -0,0 +1,175 @@
+
+# Sign every input of a transaction at once, P2PKH and native SegWit
+# P2WPKH inputs alike.
+#
+# bitcoin.sign() deserializes, copies and reserializes the whole
+# transaction for each input, so signing n inputs one at a time costs
+# O(n^2) Python work on one core. Here the transaction is parsed once,
+# each input's signature hash is cut from a single serialization with
+# every script blanked, and the ECDSA signatures, which are independent
+# of each other, are made across a process pool. Signatures are
+# deterministic (RFC 6979) so the result is byte-identical to calling
+# sign() for each input in turn.
+#
+# SegWit inputs are signed per BIP 143, whose signature hash reuses
+# three transaction wide hashes so each input costs the same no matter
+# how many inputs there are.
+
+import binascii, hashlib, multiprocessing
+from bitcoin import deserialize, serialize, serialize_script, num_to_var_int, encode
+from bitcoin import privkey_to_pubkey, pubkey_to_address, mk_pubkey_script, address_to_script
+from bitcoin import compress, bin_hash160, ecdsa_raw_sign, der_encode_sig, txhash, SIGHASH_ALL
+from validate import decode_segwit_address, encode_segwit_address
+from txsize import strip_witness
+
+
+# bytes of an input with an empty script: outpoint, script length, sequence
+blank_input_size = 32 + 4 + 1 + 4
+
+# starting a pool costs more than signing a few inputs
+parallel_min = 16
+
+# human readable part of mainnet SegWit addresses
+segwit_hrp = 'bc'
+
+
+def dbl_sha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+# True for native SegWit (bech32) addresses
+def is_segwit(address):
+    return decode_segwit_address(segwit_hrp, address)[0] is not None
+
+
+# native SegWit P2WPKH address for a public key
+def p2wpkh_address(pubkey):
+    return encode_segwit_address(segwit_hrp, 0, bytearray(bin_hash160(binascii.unhexlify(compress(pubkey)))))
+
+
+# hex output script paying address
+def output_script(address):
+    version, program = decode_segwit_address(segwit_hrp, address)
+    if version is None:
+        return address_to_script(address)
+    opcode = 0 if version == 0 else 0x50 + version
+    return binascii.hexlify(bytearray([opcode, len(program)] + program))
+
+
+# txid of a signed hex transaction, which doesn't commit to witnesses
+def signed_txid(tx):
+    return txhash(strip_witness(tx))
+
+
+# signature hash of input i given the blanked tx and the script to sign
+def signature_hash(blank, header, i, script, hashcode=SIGHASH_ALL):
+    start = header + blank_input_size * i + 36
+    preimage = blank[:start] + num_to_var_int(len(script)) + script + blank[start + 1:]
+    preimage += encode(hashcode, 256, 4)[::-1]
+    return dbl_sha256(preimage)
+
+
+# hashPrevouts, hashSequence and hashOutputs of BIP 143
+def witness_shared_hashes(blank, header, n, nouts):
+    inputs = [blank[header + blank_input_size * i:header + blank_input_size * (i + 1)] for i in range(n)]
+    prevouts = dbl_sha256(b''.join([inp[:36] for inp in inputs]))
+    sequences = dbl_sha256(b''.join([inp[-4:] for inp in inputs]))
+    outputs = dbl_sha256(blank[header + blank_input_size * n + len(num_to_var_int(nouts)):-4])
+    return prevouts, sequences, outputs
+
+
+# BIP 143 signature hash of P2WPKH input i spending value satoshis
+def witness_signature_hash(blank, header, shared, i, pubkey_hash, value, hashcode=SIGHASH_ALL):
+    start = header + blank_input_size * i
+    prevouts, sequences, outputs = shared
+    script_code = b'\x19\x76\xa9\x14' + pubkey_hash + b'\x88\xac'
+    preimage = blank[:4] + prevouts + sequences + blank[start:start + 36] + script_code
+    preimage += encode(value, 256, 8)[::-1] + blank[start + 37:start + 41] + outputs + blank[-4:]
+    preimage += encode(hashcode, 256, 4)[::-1]
+    return dbl_sha256(preimage)
+
+
+# runs in the pool workers, returns the DER signature or None
+def sign_hash(job):
+    sighash, priv, hashcode = job
+    try:
+        return der_encode_sig(*ecdsa_raw_sign(sighash, priv)) + encode(hashcode, 16, 2)
+    except Exception:
+        return None
+
+
+# Sign input i of hex tx with privkeys[i] for every input. Inputs with
+# a value in witness_values are P2WPKH outputs of that many satoshis,
+# the rest are P2PKH. Returns the signed hex tx and a list of input
+# numbers that failed to sign.
+def sign_inputs(tx, privkeys, processes=None, witness_values=None, hashcode=SIGHASH_ALL):
+
+    txobj = deserialize(binascii.unhexlify(tx))
+    n = len(txobj['ins'])
+    if len(privkeys) != n:
+        raise ValueError('Expected {} private keys, got {}'.format(n, len(privkeys)))
+    witness_values = witness_values or [None] * n
+
+    for inp in txobj['ins']:
+        inp['script'] = b''
+    blank = serialize(txobj)
+    header = 4 + len(num_to_var_int(n))
+    shared = None
+
+    # deriving the public key is an EC multiply, do it once per key
+    keys = {}
+    jobs = []
+    for i, priv in enumerate(privkeys):
+        if len(priv) <= 33:
+            priv = binascii.hexlify(priv)
+        if priv not in keys:
+            pub = privkey_to_pubkey(priv)
+            script = binascii.unhexlify(mk_pubkey_script(pubkey_to_address(pub)))
+            keys[priv] = (pub, script, compress(pub))
+
+        if witness_values[i] is None:
+            sighash = signature_hash(blank, header, i, keys[priv][1], hashcode)
+        else:
+            if shared is None:
+                shared = witness_shared_hashes(blank, header, n, len(txobj['outs']))
+            pubkey_hash = bin_hash160(binascii.unhexlify(keys[priv][2]))
+            sighash = witness_signature_hash(blank, header, shared, i, pubkey_hash, witness_values[i], hashcode)
+        jobs.append((sighash, priv, hashcode))
+
+    if not processes:
+        processes = multiprocessing.cpu_count()
+    if n < parallel_min:
+        processes = 1
+
+    if processes <= 1:
+        sigs = [sign_hash(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            sigs = pool.map(sign_hash, jobs, chunksize=max(1, n // (processes * 4)))
+        finally:
+            pool.close()
+            pool.join()
+
+    failed = [i for i in range(n) if sigs[i] is None]
+    if failed:
+        return None, failed
+
+    txobj = deserialize(tx)
+    witnesses = []
+    for i, job in enumerate(jobs):
+        pub, script, witness_pub = keys[job[1]]
+        if witness_values[i] is None:
+            txobj['ins'][i]['script'] = serialize_script([sigs[i], pub])
+            witnesses.append('00')
+        else:
+            txobj['ins'][i]['script'] = ''
+            items = [binascii.unhexlify(sigs[i]), binascii.unhexlify(witness_pub)]
+            witnesses.append(binascii.hexlify(num_to_var_int(2) + b''.join([num_to_var_int(len(x)) + x for x in items])))
+    signed = serialize(txobj)
+
+    # SegWit serialization adds a marker and flag after the version and
+    # the witnesses before the lock time
+    if shared is not None:
+        signed = signed[:8] + '0001' + signed[8:-8] + ''.join(witnesses) + signed[-8:]
+    return signed, []
@@ -0,0 +1,141 @@
+
+# Exact transaction sizes.
+#
+# Sizes are serialized bytes and vsize is virtual bytes, the weight
+# divided by 4 and rounded up (BIP 141), which is what miners charge
+# for. Before signing the signature lengths aren't known: DER encoded
+# low S signatures with the sighash byte are at most 72 bytes, usually
+# 71 or 72, so estimates are upper bounds at most a byte or so per
+# input above the signed transaction.
+
+import binascii
+from bitcoin import get_privkey_format
+from validate import decode_segwit_address
+
+
+max_sig_size = 72
+
+# scriptSig or witness public key sizes
+compressed_pubkey_size = 33
+uncompressed_pubkey_size = 65
+
+# version and lock time
+tx_fixed_size = 4 + 4
+
+# SegWit marker and flag, witness bytes
+segwit_marker_size = 2
+
+
+def var_int_size(n):
+    if n < 0xfd:
+        return 1
+    elif n <= 0xffff:
+        return 3
+    elif n <= 0xffffffff:
+        return 5
+    return 9
+
+
+# input types the wallet can sign, of SegWit outputs only version 0
+# with a 20 byte key hash (P2WPKH)
+def input_kind(address, privkey):
+    version, program = decode_segwit_address('bc', address)
+    if version is not None:
+        if version == 0 and len(program) == 20:
+            return 'p2wpkh'
+        raise ValueError('unsupported SegWit version {} output with a {} byte program'.format(version, len(program)))
+    if 'compressed' in get_privkey_format(privkey):
+        return 'p2pkh'
+    return 'p2pkh-uncompressed'
+
+
+# (non-witness bytes, witness bytes) of an input with a maximum length signature
+def input_sizes(kind):
+    if kind == 'p2wpkh':
+        witness = 1 + 1 + max_sig_size + 1 + compressed_pubkey_size
+        return (36 + 1 + 4, witness)
+    pubkey = compressed_pubkey_size if kind == 'p2pkh' else uncompressed_pubkey_size
+    script = 1 + max_sig_size + 1 + pubkey
+    return (36 + var_int_size(script) + script + 4, 0)
+
+
+# virtual bytes of one input, rounded up
+def input_vsize(kind):
+    base, witness = input_sizes(kind)
+    return (base * 4 + witness + 3) // 4
+
+
+# bytes of an output paying the hex script
+def output_size(script):
+    n = len(script) // 2
+    return 8 + var_int_size(n) + n
+
+
+# Smallest output value relays accept for the hex script, Bitcoin
+# Core's dust limit: three times the vbytes of the output and of an
+# input spending it, at the default dust relay fee of 3 satoshis per
+# vbyte.
+def dust_limit(script):
+    n = len(script) // 2
+    version = int(script[:2], 16) if n else -1
+    witness = 4 <= n <= 42 and (version == 0 or 0x51 <= version <= 0x60) and int(script[2:4], 16) == n - 2
+    spend = 32 + 4 + 1 + (107 // 4 if witness else 107) + 4
+    return (output_size(script) + spend) * 3
+
+
+# Weight of a transaction spending inputs of the given kinds to outputs
+# with the given hex scripts. Legacy inputs in a SegWit transaction
+# still take an empty witness of one byte.
+def tx_weight(kinds, scripts):
+    base = tx_fixed_size + var_int_size(len(kinds)) + var_int_size(len(scripts))
+    base += sum([input_sizes(kind)[0] for kind in kinds]) + sum([output_size(script) for script in scripts])
+    witness = 0
+    if 'p2wpkh' in kinds:
+        witness = segwit_marker_size + sum([input_sizes(kind)[1] or 1 for kind in kinds])
+    return base * 4 + witness
+
+
+def tx_vsize(kinds, scripts):
+    return (tx_weight(kinds, scripts) + 3) // 4
+
+
+# Signed hex transaction without the SegWit marker, flag and witnesses,
+# the serialization its txid hashes. The witness is whatever lies
+# between the outputs and the lock time.
+def strip_witness(tx):
+    raw = bytearray(binascii.unhexlify(tx))
+    if not (raw[4] == 0 and raw[5] == 1):
+        return tx
+    pos = 4 + segwit_marker_size
+
+    def read_var_int():
+        first = raw[pos]
+        if first < 0xfd:
+            return 1, first
+        width = { 0xfd : 2, 0xfe : 4, 0xff : 8 }[first]
+        return 1 + width, sum([raw[pos + 1 + i] << (8 * i) for i in range(width)])
+
+    length, nins = read_var_int()
+    pos += length
+    for i in range(nins):
+        pos += 36
+        length, script = read_var_int()
+        pos += length + script + 4
+    length, nouts = read_var_int()
+    pos += length
+    for i in range(nouts):
+        pos += 8
+        length, script = read_var_int()
+        pos += length + script
+
+    return binascii.hexlify(raw[:4] + raw[4 + segwit_marker_size:pos] + raw[-4:])
+
+
+# weight of a signed hex transaction, its bytes without witness data
+# count 4 times
+def signed_weight(tx):
+    return len(strip_witness(tx)) // 2 * 3 + len(tx) // 2
+
+
+def signed_vsize(tx):
+    return (signed_weight(tx) + 3) // 4
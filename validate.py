@@ -2,11 +2,30 @@
 # Functions for validating an altcoin address
 # Source: http://rosettacode.org/wiki/Bitcoin/address_validation#Python
 
-import string
+import string, binascii
 from hashlib import sha256
 
 digits58 = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
+# reverse lookup table from base58 character to its value
+values58 = dict((char, i) for (i, char) in enumerate(digits58))
+
+# characters decoded per big integer multiplication
+chunk58 = 10
+scale58 = 58 ** chunk58
+
+# results of validate_addresses() keyed by (address, magicbytes)
+_validated = {}
+
+# bech32 (BIP 173) and bech32m (BIP 350) for native SegWit addresses
+charset32 = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+values32 = dict((char, i) for (i, char) in enumerate(charset32))
+bech32_const = 1
+bech32m_const = 0x2bc830a3
+
+# human readable part of native SegWit addresses per magic byte
+segwit_hrp = { 0 : 'bc', 111 : 'tb' }
+
 def _bytes_to_long(bytestring, byteorder):
     """Convert a bytestring to a long
 
@@ -38,18 +57,33 @@ def decode_base58(bitcoin_address, length):
     This form of base58 decoding is bitcoind specific. Be careful outside of
     bitcoind context.
     """
-    n = 0
-    for char in bitcoin_address:
-        try:
-            n = n * 58 + digits58.index(char)
-        except:
-            msg = u"Character not part of Bitcoin's base58: '%s'"
-            raise ValueError(msg % (char,))
+    n = _decode_base58_int(bitcoin_address)
+    if n >> (length * 8):
+        raise ValueError(u"Address too long for %d bytes" % length)
     try:
         return n.to_bytes(length, 'big')
     except AttributeError:
         # Python version < 3.2
-        return _long_to_bytes(n, length, 'big')
+        return bytearray(binascii.unhexlify('%0*x' % (length * 2, n)))
+
+def _decode_base58_int(bitcoin_address):
+    """Decode a base58 string to an integer
+
+    Characters are mapped with a lookup table and folded into the result
+    chunk58 at a time, which keeps big integer arithmetic to a minimum.
+    """
+    n = 0
+    for start in range(0, len(bitcoin_address), chunk58):
+        chunk = bitcoin_address[start:start + chunk58]
+        value = 0
+        for char in chunk:
+            try:
+                value = value * 58 + values58[char]
+            except KeyError:
+                msg = u"Character not part of Bitcoin's base58: '%s'"
+                raise ValueError(msg % (char,))
+        n = n * (scale58 if len(chunk) == chunk58 else 58 ** len(chunk)) + value
+    return n
 
 def encode_base58(bytestring):
     """Encode a bytestring to a base58 encoded string
@@ -66,24 +100,121 @@ def encode_base58(bytestring):
     except AttributeError:
         # Python version < 3.2
         n = _bytes_to_long(bytestring, 'big')
-    result = ''
-    (n, rest) = divmod(n, 58)
-    while n or rest:
-        result += digits58[rest]
+    result = []
+    while n:
         (n, rest) = divmod(n, 58)
-    return zeros * '1' + result[::-1]  # reverse string
+        result.append(digits58[rest])
+    return zeros * '1' + ''.join(reversed(result))
+
+def _bech32_polymod(values):
+    """Compute the bech32 checksum of a list of 5 bit values
+    """
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    chk = 1
+    for value in values:
+        top = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            chk ^= generator[i] if ((top >> i) & 1) else 0
+    return chk
+
+def _bech32_hrp_expand(hrp):
+    """Expand the human readable part for checksumming
+    """
+    return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+
+def _convertbits(data, frombits, tobits, pad):
+    """Regroup a list of frombits wide values into tobits wide values
+
+    Returns None if the input has bits left over that can't be dropped.
+    """
+    acc = 0
+    bits = 0
+    result = []
+    maxv = (1 << tobits) - 1
+    for value in data:
+        if value < 0 or (value >> frombits):
+            return None
+        acc = (acc << frombits) | value
+        bits += frombits
+        while bits >= tobits:
+            bits -= tobits
+            result.append((acc >> bits) & maxv)
+    if pad:
+        if bits:
+            result.append((acc << (tobits - bits)) & maxv)
+    elif bits >= frombits or ((acc << (tobits - bits)) & maxv):
+        return None
+    return result
+
+def decode_segwit_address(hrp, address):
+    """Decode a native SegWit address
+
+    Returns (witness version, witness program as a list of byte values)
+    or (None, None) if the address is invalid for hrp.
+    >>> decode_segwit_address('bc', 'BC1QW508D6QEJXTDG4Y5R3ZARVARY0C5XW7KV8F3T4')[0]
+    0
+    """
+    if address.lower() != address and address.upper() != address:
+        return (None, None)
+    address = address.lower()
+    pos = address.rfind('1')
+    if pos < 1 or pos + 7 > len(address) or len(address) > 90:
+        return (None, None)
+    if address[:pos] != hrp:
+        return (None, None)
+    try:
+        data = [values32[x] for x in address[pos + 1:]]
+    except KeyError:
+        return (None, None)
+    const = _bech32_polymod(_bech32_hrp_expand(hrp) + data)
+    if const not in (bech32_const, bech32m_const):
+        return (None, None)
+    data = data[:-6]
+    if not data or data[0] > 16:
+        return (None, None)
+    # version 0 uses bech32, later versions bech32m
+    if const != (bech32_const if data[0] == 0 else bech32m_const):
+        return (None, None)
+    program = _convertbits(data[1:], 5, 8, False)
+    if program is None or len(program) < 2 or len(program) > 40:
+        return (None, None)
+    if data[0] == 0 and len(program) not in (20, 32):
+        return (None, None)
+    return (data[0], program)
+
+def encode_segwit_address(hrp, version, program):
+    """Encode a witness version and program as a native SegWit address
+
+    Returns None if the result doesn't decode back to the same program.
+    """
+    data = [version] + _convertbits(bytearray(program), 8, 5, True)
+    const = bech32_const if version == 0 else bech32m_const
+    polymod = _bech32_polymod(_bech32_hrp_expand(hrp) + data + [0] * 6) ^ const
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    address = hrp + '1' + ''.join([charset32[d] for d in data + checksum])
+    if decode_segwit_address(hrp, address) == (None, None):
+        return None
+    return address
 
 def validate_address(bitcoin_address, magicbyte=0):
     """Check the integrity of a bitcoin address
 
-    Returns False if the address is invalid.
+    Returns False if the address is invalid. Native SegWit (bech32)
+    addresses are accepted for the networks in segwit_hrp.
     >>> validate_address('1AGNa15ZQXAZUgFiqJ2i7Z2DPU2J6hW62i')
     True
+    >>> validate_address('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4')
+    True
     >>> validate_address('')
     False
     """
     if isinstance(magicbyte, int):
         magicbyte = (magicbyte,)
+    for mb in magicbyte:
+        hrp = segwit_hrp.get(int(mb))
+        if hrp and bitcoin_address[:len(hrp) + 1].lower() == hrp + '1':
+            return decode_segwit_address(hrp, bitcoin_address)[0] is not None
     clen = len(bitcoin_address)
     if clen < 27 or clen > 35: # XXX or 34?
         return False
@@ -104,5 +235,24 @@ def validate_address(bitcoin_address, magicbyte=0):
         return False
     # Encoded bytestring should be equal to the original address,
     # for example '14oLvT2' has a valid checksum, but is not a valid btc
-    # address
-    return bitcoin_address == encode_base58(bcbytes)
+    # address. Decoding already rejected values too large for 25 bytes,
+    # so the round trip only differs in the count of leading zeros.
+    ones = len(bitcoin_address) - len(bitcoin_address.lstrip('1'))
+    zeros = len(bcbytes) - len(bytes(bcbytes).lstrip(b'\0'))
+    return ones == zeros
+
+def validate_addresses(bitcoin_addresses, magicbyte=0):
+    """Check the integrity of many bitcoin addresses
+
+    Returns a dict mapping each address to True or False. Results are
+    memoized so repeated addresses are only checked once per process.
+    >>> validate_addresses(['1AGNa15ZQXAZUgFiqJ2i7Z2DPU2J6hW62i', ''])['']
+    False
+    """
+    key = magicbyte if isinstance(magicbyte, int) else tuple(magicbyte)
+    result = {}
+    for address in bitcoin_addresses:
+        if (address, key) not in _validated:
+            _validated[(address, key)] = validate_address(address, magicbyte)
+        result[address] = _validated[(address, key)]
+    return result
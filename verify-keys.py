@@ -8,6 +8,7 @@ import argparse, logging
 from bitcoin import privtopub, pubkey_to_address
 from btclib import logger, config
 from validate import validate_address
+from txsign import is_segwit, p2wpkh_address
 
 
 parser = argparse.ArgumentParser(description='Check for invalid key pairs in the wallet')
@@ -60,9 +61,15 @@ for entry in config['wallet']:
                 logger.debug('{} is MISSING a private key'.format(name))
             else:
                 try:
-                    # check if public key corresponds to private key
-                    derived = pubkey_to_address(privtopub(privkey))
-                    if derived != address:
+                    # check if public key corresponds to private key,
+                    # native SegWit addresses are P2WPKH
+                    pubkey = privtopub(privkey)
+                    if is_segwit(address):
+                        matched = (p2wpkh_address(pubkey) == address.lower())
+                    else:
+                        matched = (pubkey_to_address(pubkey) == address)
+                        logger.debug('{} native SegWit address is {}'.format(name, p2wpkh_address(pubkey)))
+                    if not matched:
                         logger.error('{} derived address and given address are MISMATCHED'.format(name))
                         valid = False
 
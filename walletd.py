@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# Long-running wallet daemon. Keeps the wallet index, HTTP pool, caches
+# and ledger warm and answers JSON requests on a local Unix socket. The
+# other commands use it automatically while it's running.
+
+import os, argparse, logging, json, signal, socket, threading, time, SocketServer
+from btclib import config, logger, daemon_methods, daemon_state, get_daemon_socket, get_wallet_index
+
+
+# recent price and fee quotes, keyed by method and arguments
+quotes = {}
+quotes_lock = threading.Lock()
+quote_methods = ('get_bitcoin_price', 'bitcoin_fee')
+
+
+# run a forwarded call, price and fee quotes are reused for a short time
+def dispatch(method, args, kwargs):
+
+    func = daemon_methods[method]
+    if method not in quote_methods:
+        return func(*args, **kwargs)
+
+    key = json.dumps([method, args, kwargs], sort_keys=True)
+    now = time.time()
+    with quotes_lock:
+        if key in quotes and now - quotes[key][0] < config.get('daemon-quote-ttl', 60):
+            return quotes[key][1]
+
+    result = func(*args, **kwargs)
+    if result is not None:
+        with quotes_lock:
+            quotes[key] = (now, result)
+    return result
+
+
+# one JSON request per line, one JSON reply per line
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            reply = {}
+            try:
+                request = json.loads(line)
+                method = request['method']
+                if method not in daemon_methods:
+                    raise KeyError('unknown method {}'.format(method))
+                logger.debug('Daemon request {} {}'.format(method, request['args']))
+                reply['result'] = dispatch(method, request['args'], request.get('kwargs', {}))
+
+            except (Exception, SystemExit) as e:
+                logger.error('Daemon request failed: {} {}'.format(type(e).__name__, e))
+                reply['error'] = '{} {}'.format(type(e).__name__, e)
+
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+
+# True if something answers on the Unix socket at path
+def socket_in_use(path):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        probe.close()
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Serve wallet requests from warm caches on a Unix socket')
+    parser.add_argument('-v', '--verbose', help='show verbose output', action='store_true', required=False)
+    args = vars(parser.parse_args())
+
+    if (args['verbose']):
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    daemon_state['serving'] = True
+    path = get_daemon_socket()
+
+    # a socket nobody answers on was left by a daemon that died
+    if os.path.exists(path):
+        if socket_in_use(path):
+            logger.error('Wallet daemon already running on {}'.format(path))
+            exit(1)
+        logger.warning('Removing stale socket {}'.format(path))
+        os.remove(path)
+
+    # warm up the wallet index before the first request
+    get_wallet_index()
+
+    old_umask = os.umask(0o077)
+    server = Server(path, RequestHandler)
+    os.umask(old_umask)
+
+    def shutdown(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, shutdown)
+
+    logger.info('Wallet daemon listening on {}'.format(path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+        logger.info('Wallet daemon stopped')
+
+
+if __name__ == "__main__":
+    main()